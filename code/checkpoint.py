@@ -0,0 +1,55 @@
+"""Crash safe backup cycle state"""
+
+from dataclasses import dataclass, field, asdict
+
+import json
+import os
+
+
+@dataclass
+class CycleCheckpoint:
+    """Progress of the current backup cycle."""
+    cycle_start:float = 0
+    finished:bool = False
+    next_run:float = 0
+    started:list = field(default_factory=list)
+    completed:dict = field(default_factory=dict) # Phase name to duration in seconds
+    collection_status:dict = None
+
+
+class CheckpointStore:
+    """
+    Saves the cycle checkpoint to disk after every phase change. The file is
+    written to a temporary file, synced and renamed over the old one so a
+    crash leaves either the previous or the new state, never a partial one.
+    """
+
+    def __init__(self, location:str):
+        self.location = location
+
+    def load(self) -> CycleCheckpoint:
+        """ Load the last saved checkpoint, None if there is no usable one. """
+        try:
+            with open(self.location, encoding="utf-8") as fp:
+                return CycleCheckpoint(**json.load(fp))
+        except FileNotFoundError:
+            print("No Previous Cycle State Found")
+        except (TypeError, ValueError) as e:
+            print("Ignoring Unreadable Cycle State: " + str(e))
+        return None
+
+    def save(self, checkpoint:CycleCheckpoint):
+        """ Atomically replace the saved checkpoint. """
+        directory = os.path.dirname(os.path.abspath(self.location))
+        os.makedirs(directory, exist_ok=True)
+        temp_location = self.location + ".tmp"
+        with open(temp_location, "w", encoding="utf-8") as fp:
+            json.dump(asdict(checkpoint), fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_location, self.location)
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
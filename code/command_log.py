@@ -0,0 +1,102 @@
+"""Bounded in-memory command output log"""
+
+from collections import deque
+from dataclasses import dataclass
+
+import threading
+import time
+
+import labeled_metrics
+
+
+@dataclass
+class CommandLogParams:
+    """Setup params for the command output log."""
+    buffer_bytes:int = 64 * 1024
+    forward_stdout:bool = True
+    max_stdout_lines_per_second:int = 50
+
+
+@dataclass
+class CommandLogLine:
+    """A single captured output line."""
+    timestamp:float
+    stream:str
+    text:str
+
+
+class CommandLog:
+    """
+    Keeps the last buffer_bytes of output for each command in a ring
+    buffer and optionally forwards lines to stdout, rate limited so a
+    verbose command can not flood the container log.
+    """
+
+    def __init__(self, params:CommandLogParams, backup_name:str="",
+                 lines_metric=None, dropped_lines_metric=None):
+        self.params = params
+        self.backup_name = backup_name
+        self.lines_metric = lines_metric
+        self.dropped_lines_metric = dropped_lines_metric
+        self.__lock = threading.Lock()
+        self.__buffers = {}
+        self.__buffer_sizes = {}
+        self.__stdout_tokens = float(self.params.max_stdout_lines_per_second)
+        self.__stdout_last_refill = time.monotonic()
+
+    def add_line(self, command_name:str, line:str, print_prefix:str="", stream:str="stdout"):
+        """ Record one line of command output. """
+        text = line.rstrip("\r\n")
+        with self.__lock:
+            buffer = self.__buffers.setdefault(command_name, deque())
+            buffer.append(CommandLogLine(timestamp=time.time(), stream=stream, text=text))
+            self.__buffer_sizes[command_name] = (
+                self.__buffer_sizes.get(command_name, 0) + len(text.encode("utf-8")))
+            evicted = 0
+            while self.__buffer_sizes[command_name] > self.params.buffer_bytes and len(buffer) > 1:
+                self.__buffer_sizes[command_name] -= len(buffer.popleft().text.encode("utf-8"))
+                evicted += 1
+            forward = self.params.forward_stdout and self.__take_stdout_token()
+        self.__count(self.lines_metric, command_name, stream=stream)
+        if evicted:
+            self.__count(self.dropped_lines_metric, command_name, evicted, reason="evicted")
+        if forward:
+            if stream == "stderr":
+                print(print_prefix + "[COMMAND ERROR]" + ": " + text.strip())
+            else:
+                print(print_prefix + ": " + text.strip())
+        elif self.params.forward_stdout:
+            self.__count(self.dropped_lines_metric, command_name, reason="rate_limited")
+
+    def render(self, command_name:str="") -> str:
+        """ Return buffered output as text, optionally for one command. """
+        out = []
+        with self.__lock:
+            for name, buffer in self.__buffers.items():
+                if command_name and name != command_name:
+                    continue
+                out.append("==> " + name + " <==")
+                for entry in buffer:
+                    out.append(
+                        time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(entry.timestamp))
+                        + " [" + entry.stream + "] " + entry.text)
+        return "\n".join(out) + "\n"
+
+    def __take_stdout_token(self) -> bool:
+        """ Token bucket limiting how many lines per second reach stdout. """
+        if self.params.max_stdout_lines_per_second <= 0:
+            return True
+        now = time.monotonic()
+        self.__stdout_tokens = min(
+            float(self.params.max_stdout_lines_per_second),
+            self.__stdout_tokens
+            + (now - self.__stdout_last_refill) * self.params.max_stdout_lines_per_second)
+        self.__stdout_last_refill = now
+        if self.__stdout_tokens < 1:
+            return False
+        self.__stdout_tokens -= 1
+        return True
+
+    def __count(self, metric, command_name:str, amount:int=1, **labels):
+        labeled_metrics.count(
+            metric, amount, backup_name=self.backup_name, command=command_name, **labels)
@@ -0,0 +1,202 @@
+"""Resource usage of finished commands
+
+Only the standard library may be used here as the duplicity worker imports
+this module with the interpreter duplicity is installed for.
+"""
+
+from dataclasses import dataclass
+
+import os
+import subprocess
+import threading
+import time
+
+import labeled_metrics
+
+BLOCK_SIZE = 512
+PEAK_MEMORY_INTERVAL = 0.1
+
+
+@dataclass
+class CommandUsage:
+    """
+    Resources a command and the children it waited for used, max_rss_bytes
+    is 0 when the command exited before its memory could be sampled.
+    """
+    user_seconds:float = 0
+    system_seconds:float = 0
+    max_rss_bytes:int = 0
+    read_bytes:int = 0
+    write_bytes:int = 0
+    voluntary_switches:int = 0
+    involuntary_switches:int = 0
+    elapsed:float = 0
+
+
+class PeakMemorySampler:
+    """
+    Polls the peak resident memory of a running command and its children.
+    The ru_maxrss wait4 reports can not be used as a forked child keeps the
+    high water mark of the process that forked it, even across exec, so a
+    small command run from the exporter would report the exporter's peak.
+    """
+
+    def __init__(self, pid:int, interval:float=PEAK_MEMORY_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample_loop, daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> int:
+        """ Stop sampling and return the highest peak seen in bytes. """
+        self.__stop.set()
+        self.__thread.join()
+        return self.peak
+
+    def __sample_loop(self):
+        while True:
+            self.peak = max(self.peak, read_peak_memory(self.pid))
+            if self.__stop.wait(self.interval):
+                return
+
+
+def reap(pid:int, sampler:PeakMemorySampler=None) -> tuple:
+    """
+    Wait for a child to exit and return its exit code and usage. The child
+    is left a zombie until its /proc io counters are read, they include the
+    children it reaped so helpers like gpg and ssh are counted too. Peak
+    memory comes from the sampler started with the child, if any.
+    """
+    os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+    io = read_proc_io(pid)
+    # Stop sampling while the pid can not be reused by another process
+    max_rss = sampler.stop() if sampler is not None else 0
+    _, status, rusage = os.wait4(pid, 0)
+    out = CommandUsage(
+        user_seconds=rusage.ru_utime,
+        system_seconds=rusage.ru_stime,
+        max_rss_bytes=max_rss,
+        read_bytes=io.get("read_bytes", rusage.ru_inblock * BLOCK_SIZE),
+        write_bytes=io.get("write_bytes", rusage.ru_oublock * BLOCK_SIZE),
+        voluntary_switches=rusage.ru_nvcsw,
+        involuntary_switches=rusage.ru_nivcsw)
+    return os.waitstatus_to_exitcode(status), out
+
+
+def read_proc_io(pid:int) -> dict:
+    """ Read a process's io counters, empty if the kernel does not expose them. """
+    out = {}
+    try:
+        with open("/proc/" + str(pid) + "/io", encoding="utf-8") as fp:
+            for line in fp:
+                name, _, value = line.partition(":")
+                out[name.strip()] = int(value)
+    except (OSError, ValueError):
+        return {}
+    return out
+
+
+def read_peak_memory(pid:int) -> int:
+    """
+    Highest VmHWM in bytes of a process and its running descendants, 0 once
+    the process has exited.
+    """
+    peak = 0
+    pending = [str(pid)]
+    while pending:
+        current = pending.pop()
+        try:
+            with open("/proc/" + current + "/status", encoding="utf-8") as fp:
+                for line in fp:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]) * 1024)
+                        break
+            for task in os.listdir("/proc/" + current + "/task"):
+                with open("/proc/" + current + "/task/" + task + "/children",
+                          encoding="utf-8") as fp:
+                    pending.extend(fp.read().split())
+        except (OSError, ValueError, IndexError):
+            continue
+    return peak
+
+
+def run(command:list, stdin:str="") -> tuple:
+    """
+    Run a command to completion like subprocess.run, returning its exit code,
+    stdout, stderr and usage.
+    """
+    start = time.time()
+    proc = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    sampler = PeakMemorySampler(proc.pid)
+    stderr = []
+
+    def feed_stdin():
+        # A command exiting without reading its input breaks the pipe, which
+        # close can also raise when it flushes what is left
+        try:
+            proc.stdin.write(stdin.encode("utf-8"))
+        except BrokenPipeError:
+            pass
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    threads = [
+        threading.Thread(target=feed_stdin, daemon=True),
+        threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    stdout = proc.stdout.read()
+    for thread in threads:
+        thread.join()
+    proc.stdout.close()
+    proc.stderr.close()
+    proc.returncode, usage = reap(proc.pid, sampler)
+    usage.elapsed = time.time() - start
+    return proc.returncode, stdout, b"".join(stderr), usage
+
+
+class CommandUsageRecorder:
+    """
+    Adds the usage of every finished command to labeled counters and
+    histograms, a command is recorded under the name it was run as.
+    """
+
+    def __init__(self, backup_name:str="", runs_metric=None, cpu_metric=None, io_metric=None,
+                 context_switches_metric=None, max_rss_metric=None, duration_metric=None):
+        self.backup_name = backup_name
+        self.runs_metric = runs_metric
+        self.cpu_metric = cpu_metric
+        self.io_metric = io_metric
+        self.context_switches_metric = context_switches_metric
+        self.max_rss_metric = max_rss_metric
+        self.duration_metric = duration_metric
+
+    def record(self, command_name:str, usage:CommandUsage):
+        """ Record the usage of one finished command. """
+        self.__count(self.runs_metric, command_name)
+        self.__count(self.cpu_metric, command_name, usage.user_seconds, mode="user")
+        self.__count(self.cpu_metric, command_name, usage.system_seconds, mode="system")
+        self.__count(self.io_metric, command_name, usage.read_bytes, direction="read")
+        self.__count(self.io_metric, command_name, usage.write_bytes, direction="write")
+        self.__count(
+            self.context_switches_metric, command_name, usage.voluntary_switches, kind="voluntary")
+        self.__count(
+            self.context_switches_metric, command_name, usage.involuntary_switches,
+            kind="involuntary")
+        if usage.max_rss_bytes > 0:
+            self.__observe(self.max_rss_metric, command_name, usage.max_rss_bytes)
+        self.__observe(self.duration_metric, command_name, usage.elapsed)
+
+    def __count(self, metric, command_name:str, amount:float=1, **labels):
+        labeled_metrics.count(
+            metric, amount, backup_name=self.backup_name, command=command_name, **labels)
+
+    def __observe(self, metric, command_name:str, value:float):
+        labeled_metrics.observe(
+            metric, value, backup_name=self.backup_name, command=command_name)
@@ -5,13 +5,19 @@ from enum import Enum
 
 import os
 import copy
+import re
 import time
 import subprocess
+import threading
 
 import pytz
 from datetime import datetime
 
 from size import get_size
+from selection import PathSelection
+from command_log import CommandLog, CommandLogParams
+from duplicity_worker import DuplicityWorker, WorkerProcess
+from command_usage import CommandUsageRecorder, PeakMemorySampler, reap
 
 metric_template = {
     "running":              False,
@@ -33,15 +39,44 @@ metric_template = {
     }
 }
 
+# Always excluded from the backup and the local size walk
+DEFAULT_EXCLUDE_BACKUP_DIRS = ["/backup/data/lost+found"]
+
 collection_status_metrics_template = {
+    "getSuccess":             False,
     "fullBackups": {
         "num":                0
     },
     "incrementalBackups": {
         "num":                0
+    },
+    "chains":                 [], # Backup chains, each {"startTime": int, "full": int, "incremental": int}
+    "orphanedSets":           0,  # Backup sets not part of any chain
+    "incompleteSets":         0,  # Partially uploaded backup sets
+    "cleanupWarnings":        0   # Orphaned or partial files duplicity warned about
+}
+
+# Older duplicity logs "Warning, found ..." to stderr, newer "WARNING. found ..." to stdout
+CLEANUP_WARNING_REGEX = re.compile(r"^warning[,.]? found ", re.IGNORECASE)
+
+retention_plan_template = {
+    "removeAllButNFull": {
+        "run":                False,
+        "chains":             0,
+        "sets":               0
+    },
+    "removeAllIncOfButNFull": {
+        "run":                False,
+        "sets":               0
+    },
+    "cleanup": {
+        "run":                False,
+        "sets":               0
     }
 }
 
+COLLECTION_STATUS_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+
 class DuplicityBackupMethod(Enum):
     """An enum to control backup storage location connection type."""
     UNKNOWN = 0
@@ -49,6 +84,12 @@ class DuplicityBackupMethod(Enum):
     LOCAL = 2
 
 
+class DuplicityExecutionMode(Enum):
+    """An enum to control how duplicity commands are run."""
+    CLI = 0
+    WORKER = 1
+
+
 @dataclass
 class SSHParams():
     """Setup params for ssh params."""
@@ -70,6 +111,44 @@ class DuplicityLocationParams():
     restore_confirm_file_path:str = "/backup/data/restore_confirm"
 
 
+@dataclass
+class DuplicityTarget:
+    """A storage location backups are written to."""
+    backup_method:DuplicityBackupMethod = DuplicityBackupMethod.SSH
+    remote_path:str = "/home/duplicity/backup"
+    ssh_params:SSHParams = None
+
+
+def target_url(target:DuplicityTarget) -> str:
+    """ Duplicity url of a target. """
+    if target.backup_method == DuplicityBackupMethod.SSH:
+        return "rsync://" + target.ssh_params.user + "@" + target.ssh_params.host + "/" + target.remote_path
+    if target.backup_method == DuplicityBackupMethod.LOCAL:
+        return "file://" + target.remote_path
+    return ""
+
+
+def parse_target_url(url:str, ssh_params:SSHParams) -> DuplicityTarget:
+    """ Parse a file:// or rsync://user@host/path url into a target. """
+    url = url.strip()
+    if url.startswith("file://"):
+        return DuplicityTarget(
+            backup_method=DuplicityBackupMethod.LOCAL, remote_path=url[len("file://"):])
+    if url.startswith("rsync://"):
+        location, _, remote_path = url[len("rsync://"):].partition("/")
+        user, _, host = location.rpartition("@")
+        return DuplicityTarget(
+            backup_method=DuplicityBackupMethod.SSH,
+            remote_path=remote_path,
+            ssh_params=SSHParams(
+                port=ssh_params.port,
+                key_file=ssh_params.key_file,
+                user=user or ssh_params.user,
+                host=host,
+                strict_host_key_checking=ssh_params.strict_host_key_checking))
+    raise ValueError("Unsupported target url: " + url)
+
+
 @dataclass
 class DuplicityParams:
     """Setup params for dupliciy class."""
@@ -78,17 +157,34 @@ class DuplicityParams:
     remove_all_but_n_full:int = 0
     remove_all_inc_of_but_n_full:int = 0
     exclude_backup_dirs:str = ""
+    include_backup_dirs:str = ""
     restore_to_time:str = ""
     verbosity:str = ""
     allow_source_mismatch:bool = True
     backup_method:DuplicityBackupMethod = DuplicityBackupMethod.SSH
+    execution_mode:DuplicityExecutionMode = DuplicityExecutionMode.CLI
     ssh_params:SSHParams = None
+    extra_targets:list = field(default_factory=list)
+    fanout_parallelism:int = 2
+    fanout_staging_path:str = "/home/duplicity/.cache/duplicity/fanout"
 
 
 class Duplicity:
     """ Class to handle Duplicity commands. """
-    def __init__(self, params:DuplicityParams):
+    def __init__(self, params:DuplicityParams, command_log:CommandLog=None,
+                 usage_recorder:CommandUsageRecorder=None):
         self.params = params
+        self.command_log = command_log or CommandLog(CommandLogParams())
+        self.usage_recorder = usage_recorder or CommandUsageRecorder()
+        self.selection = PathSelection.from_globs(
+            include_globs=self.params.include_backup_dirs.split(","),
+            exclude_globs=(
+                self.params.exclude_backup_dirs.split(",") + DEFAULT_EXCLUDE_BACKUP_DIRS))
+        self.worker = None
+        if self.params.execution_mode == DuplicityExecutionMode.WORKER:
+            worker = DuplicityWorker()
+            if worker.start():
+                self.worker = worker
 
     def run_pre_backup(self) -> dict:
         """ Run pre backup processing. """
@@ -98,49 +194,101 @@ class Duplicity:
         """ Run backup and return metrics. """
         logs = self.__capture_command_out(
             command=self.__build_duplicity_command(),
-            print_prefix="[Duplicity Ouput]")
+            print_prefix="[Duplicity Ouput]",
+            command_name="backup")
         return self.__process_duplicity_logs(logs)
 
     def run_collection_status(self) -> dict:
         """ Run duplicity cleanup. """
         print("[Duplicity Collection Status]: Starting Collection Status")
+        errors = []
         log = self.__capture_command_out(
             command=self.__build_duplicity_collection_status_command(),
-            print_prefix="[Duplicity Collection Status]")
-        return self.__process_duplicity_collection_status(log)
+            print_prefix="[Duplicity Collection Status]",
+            command_name="collection-status",
+            stderr_out=errors)
+        return self.__process_duplicity_collection_status(log, errors)
+
+    def plan_retention(self, collection_status:dict) -> dict:
+        """
+        Work out from a collection status what the old backup clean and
+        cleanup commands would delete so they are only run when needed.
+        """
+        out = copy.deepcopy(retention_plan_template)
+        if not collection_status.get("getSuccess", False):
+            # Without a chain listing we can not tell, so run everything
+            out["removeAllButNFull"]["run"] = self.params.remove_all_but_n_full > 0
+            out["removeAllIncOfButNFull"]["run"] = self.params.remove_all_inc_of_but_n_full > 0
+            out["cleanup"]["run"] = True
+            return out
+
+        chains = sorted(collection_status["chains"], key=lambda chain: chain["startTime"])
+        if 0 < self.params.remove_all_but_n_full < len(chains):
+            removed = chains[:-self.params.remove_all_but_n_full]
+            chains = chains[-self.params.remove_all_but_n_full:]
+            out["removeAllButNFull"]["run"] = True
+            out["removeAllButNFull"]["chains"] = len(removed)
+            out["removeAllButNFull"]["sets"] = sum(
+                chain["full"] + chain["incremental"] for chain in removed)
+        if 0 < self.params.remove_all_inc_of_but_n_full < len(chains):
+            sets = sum(
+                chain["incremental"]
+                for chain in chains[:-self.params.remove_all_inc_of_but_n_full])
+            out["removeAllIncOfButNFull"]["run"] = sets > 0
+            out["removeAllIncOfButNFull"]["sets"] = sets
+        sets = collection_status["orphanedSets"] + collection_status["incompleteSets"]
+        # Orphaned signatures and local partial files are only reported as warnings
+        out["cleanup"]["run"] = sets > 0 or collection_status.get("cleanupWarnings", 0) > 0
+        out["cleanup"]["sets"] = sets
+        return out
 
-    def run_cleanup(self) -> dict:
-        """ Run duplicity cleanup. """
+    def run_cleanup(self, plan:dict=None) -> dict:
+        """ Run duplicity cleanup, skipped if a retention plan says there is nothing to do. """
+        if plan is not None and not plan["cleanup"]["run"]:
+            print("[Duplicity Cleanup]: Nothing to clean up so cleanup was not run")
+            return {"sucess": True, "ran": False}
         print("[Duplicity Cleanup]: Starting old backup clean")
         log = self.__capture_command_out(
             command=self.__build_duplicity_cleanup_command(),
-            print_prefix="[Duplicity Cleanup]")
-        return {"sucess": True}
-
-    def run_old_backup_clean(self) -> dict:
-        """ Run cleanup of old backups. """
-        if self.params.remove_all_but_n_full > 0:
+            print_prefix="[Duplicity Cleanup]",
+            command_name="cleanup")
+        return {"sucess": True, "ran": True}
+
+    def run_old_backup_clean(self, plan:dict=None) -> dict:
+        """ Run cleanup of old backups, skipping commands a retention plan says are no-ops. """
+        ran = False
+        if plan is not None and self.params.remove_all_but_n_full > 0 and not plan["removeAllButNFull"]["run"]:
+            print("[Duplicity Old Full Backup Cleanup]: No old full backups to remove so clean was not run")
+        elif self.params.remove_all_but_n_full > 0:
             print("[Duplicity Old Full Backup Cleanup]: Starting old backup clean")
             log = self.__capture_command_out(
                 command=self.__build_duplicity_old_full_backup_clean_command(),
-                print_prefix="[Duplicity Old Full Backup Cleanup]")
+                print_prefix="[Duplicity Old Full Backup Cleanup]",
+                command_name="remove-all-but-n-full")
+            ran = True
         else:
             print("[Duplicity Old Full Backup Cleanup]: 0 \"remove_all_but_n_full\" given so clean was not run")
-        if self.params.remove_all_inc_of_but_n_full > 0:
+        if (plan is not None and self.params.remove_all_inc_of_but_n_full > 0
+                and not plan["removeAllIncOfButNFull"]["run"]):
+            print("[Duplicity Old Backup Incremental Cleanup]: No old incremental backups to remove so clean was not run")
+        elif self.params.remove_all_inc_of_but_n_full > 0:
             print("[Duplicity Old Backup Incremental Cleanup]: Starting old backup clean")
             log = self.__capture_command_out(
                 command=self.__build_duplicity_old_incremental_backup_clean_command(),
-                print_prefix="[Duplicity Old Backup Incremental Cleanup]")
+                print_prefix="[Duplicity Old Backup Incremental Cleanup]",
+                command_name="remove-all-inc-of-but-n-full")
+            ran = True
         else:
             print("[Duplicity Old Backup Incremental Cleanup]: 0 \"remove_all_but_n_full\" given so clean was not run")
-        return {"sucess": True}
+        return {"sucess": True, "ran": ran}
 
     def run_restore(self) -> bool:
         """ Run restore and return success. """
         if self.__check_restore_confirmation_file():
             self.__capture_command_out(
                 command=self.__build_duplicity_restore_command(),
-                print_prefix="[Duplicity Restore Ouput]")
+                print_prefix="[Duplicity Restore Ouput]",
+                command_name="restore")
             restore_time = self.__write_restore_confirmation_file_completion()
             print(
                 "[Duplicity Restore Ouput]: Restore complete with output time: "
@@ -151,8 +299,16 @@ class Duplicity:
             print("You may need to run: echo \"restore\" > " + self.params.location_params.restore_confirm_file_path)
         return False
 
+    @property
+    def primary_target(self) -> DuplicityTarget:
+        """ The target duplicity commands run against. """
+        return DuplicityTarget(
+            backup_method=self.params.backup_method,
+            remote_path=self.params.location_params.remote_path,
+            ssh_params=self.params.ssh_params)
+
     def get_local_size(self) -> int:
-        return get_size(self.params.location_params.local_path)
+        return get_size(self.params.location_params.local_path, self.selection)
 
     def get_backup_size(self) -> int:
         return get_size(self.params.location_params.remote_path)
@@ -165,10 +321,7 @@ class Duplicity:
             out.append("--full-if-older-than=" + self.params.full_if_older_than)
         if self.params.verbosity:
             out.append("--verbosity=" + self.params.verbosity)
-        if self.params.exclude_backup_dirs:
-            for exclude_dir in self.params.exclude_backup_dirs.split(","):
-                out.append("--exclude=" + exclude_dir)
-        out.append("--exclude=/backup/data/lost+found")
+        out.extend(self.selection.duplicity_args())
         out.append(self.params.location_params.local_path)
         if self.params.backup_method == DuplicityBackupMethod.SSH:
             rsync_location = "rsync://"
@@ -308,36 +461,73 @@ class Duplicity:
         """ Run post backup processing. """
         self.__capture_command_out(
             command=self.__build_duplicity_restore_test_command(),
-            print_prefix="[Duplicity Restore Test Ouput]")
+            print_prefix="[Duplicity Restore Test Ouput]",
+            command_name="restore-test")
         return self.__read_duplicity_restore_test_file()
 
-    def __capture_command_out(self, command:list, print_prefix="") -> list:
-        """ Runs a command on the command line and returns output. """
+    def __capture_command_out(self, command:list, print_prefix="", command_name="",
+                              stderr_out:list=None) -> list:
+        """
+        Runs a command on the command line and returns output, collecting
+        stderr lines in stderr_out if given.
+        """
         if str(os.getenv("PASSPHRASE", "")) == "":
             raise Exception("PASSPHRASE not set!")
         if print_prefix:
             print(print_prefix + "[Command]: " + " ".join(command))
         my_env = os.environ.copy()
-        proc = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=my_env
-            )
+        start = time.time()
+        proc = None
+        if self.worker is not None and self.worker.running:
+            try:
+                proc = self.worker.popen(command, my_env)
+            except OSError as e:
+                print("[Duplicity Worker]: Worker failed, using CLI: " + str(e))
+        if proc is None:
+            proc = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=my_env
+                )
+        sampler = None if isinstance(proc, WorkerProcess) else PeakMemorySampler(proc.pid)
         out = []
+        # stderr is drained in the background so a command filling the stderr
+        # pipe can not block while stdout is still being read
+        stderr_reader = threading.Thread(
+            target=self.__read_command_stream,
+            args=(proc.stderr, command_name, print_prefix, "stderr", stderr_out),
+            daemon=True)
+        stderr_reader.start()
+        try:
+            self.__read_command_stream(proc.stdout, command_name, print_prefix, "stdout", out)
+        finally:
+            # Always reap the command, a worker command holds the worker
+            # until it is waited for
+            proc.stdout.close()
+            stderr_reader.join()
+            proc.stderr.close()
+            if isinstance(proc, WorkerProcess):
+                proc.wait()
+                usage = proc.usage
+            else:
+                proc.returncode, usage = reap(proc.pid, sampler)
+        usage.elapsed = time.time() - start
+        self.usage_recorder.record(command_name, usage)
+        return out
+
+    def __read_command_stream(self, stream, command_name:str, print_prefix:str,
+                              stream_name:str, out:list=None):
+        """ Log every line of a command output stream, collecting the lines in out if given. """
         while True:
-            line = proc.stdout.readline()
-            if not line:
-                break
-            if print_prefix:
-                print(print_prefix + ": " + line.decode('utf-8', errors='replace').strip())
-            out.append(line.decode('utf-8', errors='replace'))
-        while True:
-            line = proc.stderr.readline()
+            line = stream.readline()
             if not line:
                 break
-            print(print_prefix + "[COMMAND ERROR]" + ": " + line.decode('utf-8', errors='replace').strip())
-        return out
+            decoded = line.decode('utf-8', errors='replace')
+            self.command_log.add_line(
+                command_name, decoded, print_prefix=print_prefix, stream=stream_name)
+            if out is not None:
+                out.append(decoded)
 
     def __process_duplicity_logs(self, log_output:list) -> dict:
         """ Process duplicity logs to extract metrics. """
@@ -378,20 +568,50 @@ class Duplicity:
                 reached_stats = True
         return out
 
-    def __process_duplicity_collection_status(self, log_output:list) -> dict:
+    def __process_duplicity_collection_status(self, log_output:list, error_output:list=None) -> dict:
         """ Process duplicity collection status to extract metrics. """
         out = copy.deepcopy(collection_status_metrics_template)
+        out["cleanupWarnings"] = sum(
+            1 for line in log_output + (error_output or []) if CLEANUP_WARNING_REGEX.match(line))
         reached_stats = False
+        chain = None
         for line in log_output:
             if reached_stats:
                 if line.replace(" ", "").startswith("Full"):
                     out["fullBackups"]["num"] += 1
+                    if chain is not None:
+                        chain["full"] += 1
                 elif line.replace(" ", "").startswith("Incremental"):
                     out["incrementalBackups"]["num"] += 1
+                    if chain is not None:
+                        chain["incremental"] += 1
+                elif line.startswith("Chain start time:"):
+                    chain = {
+                        "startTime": self.__process_collection_status_time(
+                            line[len("Chain start time:"):].strip(), len(out["chains"])),
+                        "full": 0,
+                        "incremental": 0
+                    }
+                    out["chains"].append(chain)
+                else:
+                    orphaned = re.search(r"found (\d+) backup set(?:s|\(s\))? not part of any chain", line)
+                    if orphaned:
+                        out["orphanedSets"] = int(orphaned.group(1))
+                    incomplete = re.search(r"(\d+) incomplete backup set(?:s|\(s\))?", line)
+                    if incomplete:
+                        out["incompleteSets"] = int(incomplete.group(1))
             elif line.startswith("Collection Status"):
                 reached_stats = True
+                out["getSuccess"] = True
         return out
 
+    def __process_collection_status_time(self, time_string:str, fallback:int) -> int:
+        """ Process a collection status chain time, falling back to listing order. """
+        try:
+            return int(datetime.strptime(time_string, COLLECTION_STATUS_TIME_FORMAT).timestamp())
+        except ValueError:
+            return fallback
+
     def __write_duplicity_restore_test_file(self) -> dict:
         """ Write a date file to check restore works correctly. """
         out = {
@@ -0,0 +1,244 @@
+"""Persistent duplicity worker process
+
+The worker is started once with the interpreter duplicity is installed for,
+imports duplicity and its backends, then forks a fresh child for every
+command. Each child runs the duplicity script exactly like the CLI would, so
+its output is identical, but skips interpreter startup and module imports.
+Command output pipes are passed to the worker over a unix socket so the
+exporter reads them the same way it reads a subprocess.
+
+Only the standard library may be used here as the worker interpreter may not
+have the exporter's dependencies installed.
+"""
+
+from dataclasses import asdict
+
+import json
+import os
+import runpy
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+
+from command_usage import CommandUsage, PeakMemorySampler, reap
+
+MAX_MESSAGE = 1024 * 1024
+MIN_DUPLICITY_VERSION = (0, 8)
+PRELOAD_MODULES = [
+    "duplicity.__main__",
+    "duplicity.dup_main",
+    "duplicity.cli_main",
+    "duplicity.commandline",
+    "duplicity.backend",
+    "duplicity.gpg",
+    "duplicity.dup_collections",
+    "duplicity.collections",
+    "duplicity.diffdir",
+    "duplicity.patchdir",
+    "duplicity.selection",
+]
+
+
+class WorkerProcess:
+    """Popen like handle to a command running in the worker."""
+
+    def __init__(self, worker, stdout, stderr):
+        self.worker = worker
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self.usage = CommandUsage()
+
+    def wait(self) -> int:
+        """ Wait for the command to exit and return its exit code. """
+        if self.returncode is None:
+            self.stdout.close()
+            self.stderr.close()
+            response = self.worker.finish_command()
+            self.returncode = response.get("returncode", 1)
+            self.usage = CommandUsage(**response.get("usage", {}))
+        return self.returncode
+
+
+class DuplicityWorker:
+    """
+    Exporter side of the worker. Commands are run one at a time, start()
+    returns False if the installed duplicity can not be run in the worker.
+    """
+
+    def __init__(self, executable:str="duplicity"):
+        self.executable = executable
+        self.version = ""
+        self.__process = None
+        self.__socket = None
+        self.__lock = threading.Lock()
+
+    def start(self) -> bool:
+        """ Start the worker and check the installed duplicity is compatible. """
+        script = shutil.which(self.executable)
+        interpreter = self.__script_interpreter(script)
+        if not interpreter:
+            print("[Duplicity Worker]: " + str(script) + " is not a python script, using CLI")
+            return False
+        local_socket, worker_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.__process = subprocess.Popen(
+            interpreter + [os.path.abspath(__file__), script, str(worker_socket.fileno())],
+            stdin=subprocess.DEVNULL,
+            pass_fds=[worker_socket.fileno()])
+        worker_socket.close()
+        self.__socket = local_socket
+        try:
+            handshake = json.loads(self.__socket.recv(MAX_MESSAGE) or b"{}")
+        except (OSError, ValueError):
+            handshake = {}
+        if not handshake.get("ready", False):
+            print("[Duplicity Worker]: Not compatible, using CLI: "
+                  + str(handshake.get("reason", "worker exited")))
+            self.stop()
+            return False
+        self.version = handshake["version"]
+        print("[Duplicity Worker]: Started for duplicity " + self.version)
+        return True
+
+    def stop(self):
+        """ Stop the worker. """
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+        if self.__process is not None:
+            self.__process.wait()
+            self.__process = None
+
+    @property
+    def running(self) -> bool:
+        return self.__process is not None and self.__process.poll() is None
+
+    def popen(self, command:list, env:dict) -> WorkerProcess:
+        """ Run a duplicity command in the worker. """
+        self.__lock.acquire()
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        try:
+            request = json.dumps({"argv": command, "env": env}).encode("utf-8")
+            socket.send_fds(self.__socket, [request], [stdout_write, stderr_write])
+        except OSError:
+            os.close(stdout_read)
+            os.close(stderr_read)
+            self.__lock.release()
+            self.stop()
+            raise
+        finally:
+            os.close(stdout_write)
+            os.close(stderr_write)
+        return WorkerProcess(self, os.fdopen(stdout_read, "rb"), os.fdopen(stderr_read, "rb"))
+
+    def finish_command(self) -> dict:
+        """ Read the exit status of the running command. """
+        try:
+            return json.loads(self.__socket.recv(MAX_MESSAGE) or b"{}")
+        except (OSError, ValueError):
+            self.stop()
+            return {}
+        finally:
+            self.__lock.release()
+
+    @staticmethod
+    def __script_interpreter(script:str) -> list:
+        """ Read the python interpreter from a script's shebang line. """
+        if not script:
+            return []
+        try:
+            with open(script, "rb") as fp:
+                first_line = fp.readline(256).decode("utf-8", errors="replace")
+        except OSError:
+            return []
+        if not first_line.startswith("#!") or "python" not in first_line:
+            return []
+        return first_line[2:].split()
+
+
+def load_duplicity() -> str:
+    """ Import duplicity and everything a command needs, returning its version. """
+    # The exporter's own duplicity.py would shadow the real package
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:] = [path for path in sys.path
+                   if os.path.abspath(path or ".") != script_directory]
+    import duplicity
+    version = str(getattr(duplicity, "__version__", "0"))
+    version_tuple = tuple(int(part) for part in version.split(".")[:2] if part.isdigit())
+    if version_tuple < MIN_DUPLICITY_VERSION:
+        raise ImportError("duplicity " + version + " is older than the worker supports")
+    for module in PRELOAD_MODULES:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+    backend = sys.modules.get("duplicity.backend")
+    if backend is not None and hasattr(backend, "import_backends"):
+        backend.import_backends()
+    return version
+
+
+def run_child(script:str, request:dict, fds:list, worker_socket:socket.socket):
+    """ Run one duplicity command in a forked child, never returns. """
+    code = 1
+    try:
+        worker_socket.close()
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in fds:
+            os.close(fd)
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = [script] + request["argv"][1:]
+        runpy.run_path(script, run_name="__main__")
+        code = 0
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            code = e.code
+        elif e.code is None:
+            code = 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def worker_main(script:str, fd:int):
+    """ Serve commands from the exporter until it closes the socket. """
+    worker_socket = socket.socket(fileno=fd)
+    try:
+        version = load_duplicity()
+    except Exception as e:
+        worker_socket.send(json.dumps({"ready": False, "reason": str(e)}).encode("utf-8"))
+        return
+    worker_socket.send(json.dumps({"ready": True, "version": version}).encode("utf-8"))
+    while True:
+        data, fds, _, _ = socket.recv_fds(worker_socket, MAX_MESSAGE, 2)
+        if not data:
+            return
+        request = json.loads(data)
+        pid = os.fork()
+        if pid == 0:
+            run_child(script, request, fds, worker_socket)
+        sampler = PeakMemorySampler(pid)
+        for child_fd in fds:
+            os.close(child_fd)
+        returncode, usage = reap(pid, sampler)
+        worker_socket.send(json.dumps({
+            "returncode": returncode,
+            "usage": asdict(usage),
+        }).encode("utf-8"))
+
+
+if __name__ == "__main__":
+    worker_main(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,51 @@
+"""Exporter HTTP server serving metrics and debug endpoints"""
+
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+import threading
+from prometheus_client import make_wsgi_app
+from prometheus_client.exposition import ThreadingWSGIServer
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler that does not log every scrape to stderr."""
+    def log_message(self, format, *args):
+        pass
+
+
+class ExporterServer:
+    """
+    WSGI app that serves prometheus metrics on every path except the
+    extra routes registered with add_route.
+    """
+
+    def __init__(self, port:int):
+        self.port = port
+        self.routes = {}
+        self.metrics_app = make_wsgi_app()
+
+    def add_route(self, path:str, handler):
+        """
+        Register a handler called with the parsed query string that returns
+        a (status, content_type, body) tuple.
+        """
+        self.routes[path] = handler
+
+    def start(self):
+        """ Start serving in a background thread. """
+        server = make_server(
+            "", self.port, self, ThreadingWSGIServer, handler_class=QuietRequestHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+    def __call__(self, environ, start_response):
+        handler = self.routes.get(environ.get("PATH_INFO", "/"))
+        if handler is None:
+            return self.metrics_app(environ, start_response)
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        status, content_type, body = handler(query)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        start_response(status, [("Content-Type", content_type)])
+        return [body]
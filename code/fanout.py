@@ -0,0 +1,260 @@
+"""Copy finished backup files from the primary target to extra targets"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import os
+import re
+import shlex
+import shutil
+import time
+
+import command_usage
+from duplicity import DuplicityBackupMethod, DuplicityTarget, target_url
+
+DUPLICITY_FILE_PREFIX = "duplicity-"
+FULL_MANIFEST_REGEX = re.compile(r"^duplicity-full\.[^.]+\.manifest")
+INCREMENTAL_MANIFEST_REGEX = re.compile(r"^duplicity-inc\.[^.]+\.to\.[^.]+\.manifest")
+RSYNC_PARTIAL_TRANSFER = 23
+
+
+@dataclass
+class TargetListing:
+    """Duplicity files on a target with their sizes."""
+    success:bool = False
+    files:dict = None
+
+    @property
+    def full_backups(self) -> int:
+        return sum(1 for name in self.files or {} if FULL_MANIFEST_REGEX.match(name))
+
+    @property
+    def incremental_backups(self) -> int:
+        return sum(1 for name in self.files or {} if INCREMENTAL_MANIFEST_REGEX.match(name))
+
+    @property
+    def size(self) -> int:
+        return sum((self.files or {}).values())
+
+
+@dataclass
+class TargetSyncResult:
+    """Outcome of copying to one extra target."""
+    target:str
+    success:bool = False
+    copied_files:int = 0
+    copied_bytes:int = 0
+    deleted_files:int = 0
+    elapsed:float = 0
+    listing:TargetListing = None
+
+
+class TargetReplicator:
+    """
+    Mirrors the duplicity files of the primary target onto extra targets so
+    the source is only read, compressed and encrypted once. Files missing on
+    a target are copied and files no longer on the primary are removed.
+    A remote primary has the missing files pulled once into a staging
+    directory which is then pushed to every target in parallel.
+    """
+
+    def __init__(self, source:DuplicityTarget, targets:list, parallelism:int=2,
+                 staging_path:str="", command_log=None, usage_recorder=None):
+        self.source = source
+        self.targets = targets
+        self.parallelism = max(1, parallelism)
+        self.staging_path = staging_path
+        self.command_log = command_log
+        self.usage_recorder = usage_recorder
+
+    def run(self) -> list:
+        """ Sync every extra target, returning a result per target. """
+        source_listing = self.list_target(self.source)
+        if not source_listing.success or source_listing.full_backups == 0:
+            # Never mirror an empty or unreadable primary over good copies
+            print("[Duplicity Fan Out]: Primary target has no readable full backup, not syncing")
+            return [TargetSyncResult(target=target_url(target), listing=self.list_target(target))
+                    for target in self.targets]
+
+        listings = {target_url(target): self.list_target(target) for target in self.targets}
+        missing = {}
+        for target in self.targets:
+            listing = listings[target_url(target)]
+            missing[target_url(target)] = sorted(
+                name for name, size in source_listing.files.items()
+                if listing.files.get(name) != size) if listing.success else []
+
+        staging = self.source.remote_path
+        if self.source.backup_method != DuplicityBackupMethod.LOCAL:
+            staging = self.staging_path
+            os.makedirs(staging, exist_ok=True)
+            needed = sorted(set(name for names in missing.values() for name in names))
+            if needed and not self.__copy_files(self.source, None, staging, needed):
+                # Without the staged files no target can be brought up to date,
+                # leave every target exactly as it is
+                print("[Duplicity Fan Out]: Unable to stage files from primary target, not syncing")
+                self.__clear_staging()
+                return [TargetSyncResult(target=url, listing=listing)
+                        for url, listing in listings.items()]
+
+        with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+            out = list(pool.map(
+                lambda target: self.__sync_target(
+                    target, staging, source_listing, listings[target_url(target)],
+                    missing[target_url(target)]),
+                self.targets))
+
+        if staging == self.staging_path:
+            self.__clear_staging()
+        return out
+
+    def list_target(self, target:DuplicityTarget) -> TargetListing:
+        """ List the duplicity files on a target. """
+        out = TargetListing(files={})
+        if target.backup_method == DuplicityBackupMethod.LOCAL:
+            try:
+                with os.scandir(target.remote_path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(DUPLICITY_FILE_PREFIX) and entry.is_file():
+                            out.files[entry.name] = entry.stat().st_size
+                out.success = True
+            except FileNotFoundError:
+                out.success = True
+            except OSError as e:
+                print("[Duplicity Fan Out]: Unable to list " + target_url(target) + ": " + str(e))
+            return out
+
+        returncode, lines, errors = self.__run(
+            ["rsync", "--list-only", rsync_location(target) + "/"], "fanout-list")
+        if returncode == RSYNC_PARTIAL_TRANSFER \
+                and any("No such file or directory" in line for line in errors):
+            # A new target has no directory yet, it is created when copying
+            out.success = True
+        elif returncode == 0:
+            for line in lines:
+                fields = line.split()
+                if len(fields) >= 5 and fields[0].startswith("-") \
+                        and fields[-1].startswith(DUPLICITY_FILE_PREFIX):
+                    out.files[fields[-1]] = int(fields[1].replace(",", "").replace(".", ""))
+            out.success = True
+        return out
+
+    def __sync_target(self, target:DuplicityTarget, staging:str, source_listing:TargetListing,
+                      listing:TargetListing, missing:list) -> TargetSyncResult:
+        """ Copy missing files to a target then remove files the primary no longer has. """
+        out = TargetSyncResult(target=target_url(target), listing=listing)
+        start = time.time()
+        copied = listing.success and self.__copy_files(None, staging, target, missing)
+        if listing.success:
+            out.listing = self.list_target(target)
+        if copied:
+            out.copied_files = len(missing)
+            out.copied_bytes = sum(source_listing.files[name] for name in missing)
+            # Only remove stale files once the target is known to hold every
+            # file the primary has, so a failed copy never costs a good backup
+            if out.listing.success and all(
+                    out.listing.files.get(name) == size
+                    for name, size in source_listing.files.items()):
+                stale = sorted(
+                    name for name in out.listing.files if name not in source_listing.files)
+                out.success = self.__delete_files(target, stale)
+                if out.success:
+                    out.deleted_files = len(stale)
+                    out.listing.files = {name: size for name, size in out.listing.files.items()
+                                         if name not in stale}
+                else:
+                    out.listing = self.list_target(target)
+            else:
+                print("[Duplicity Fan Out]: " + out.target
+                      + " is missing files after copying, not removing stale files")
+        out.elapsed = time.time() - start
+        print("[Duplicity Fan Out]: " + out.target + " copied " + str(out.copied_files)
+              + " files, removed " + str(out.deleted_files) + " files, success: " + str(out.success))
+        return out
+
+    def __clear_staging(self):
+        """ Remove staged duplicity files. """
+        for name in os.listdir(self.staging_path):
+            if name.startswith(DUPLICITY_FILE_PREFIX):
+                os.remove(os.path.join(self.staging_path, name))
+
+    def __copy_files(self, source:DuplicityTarget, source_path:str, destination, names:list) -> bool:
+        """
+        Copy named files from a target or local path to a target or local path,
+        using rsync when either side is remote.
+        """
+        if not names:
+            return True
+        if source is not None and source.backup_method == DuplicityBackupMethod.LOCAL:
+            source, source_path = None, source.remote_path
+        if isinstance(destination, DuplicityTarget) \
+                and destination.backup_method == DuplicityBackupMethod.LOCAL:
+            destination = destination.remote_path
+        if source is None and isinstance(destination, str):
+            try:
+                os.makedirs(destination, exist_ok=True)
+                for name in names:
+                    shutil.copyfile(
+                        os.path.join(source_path, name), os.path.join(destination, name + ".part"))
+                    os.replace(
+                        os.path.join(destination, name + ".part"), os.path.join(destination, name))
+                return True
+            except OSError as e:
+                print("[Duplicity Fan Out]: Copy failed: " + str(e))
+                return False
+        source_location = rsync_location(source) if source is not None else source_path
+        destination_location = (
+            destination if isinstance(destination, str) else rsync_location(destination))
+        command = ["rsync", "--times", "--files-from=-"]
+        if isinstance(destination, DuplicityTarget):
+            # Create the target directory on the server if this is its first copy
+            command.append("--rsync-path=mkdir -p " + shlex.quote(destination.remote_path)
+                           + " && rsync")
+        returncode, _, _ = self.__run(
+            command + [source_location + "/", destination_location + "/"],
+            "fanout-copy", "\n".join(names))
+        return returncode == 0
+
+    def __delete_files(self, target:DuplicityTarget, names:list) -> bool:
+        """ Remove named files from a target. """
+        if not names:
+            return True
+        if target.backup_method == DuplicityBackupMethod.LOCAL:
+            try:
+                for name in names:
+                    os.remove(os.path.join(target.remote_path, name))
+                return True
+            except OSError as e:
+                print("[Duplicity Fan Out]: Delete failed: " + str(e))
+                return False
+        # Sync an empty directory with only the stale names included so rsync
+        # deletes exactly those files and leaves everything else alone
+        empty = os.path.join(self.staging_path, "empty")
+        os.makedirs(empty, exist_ok=True)
+        returncode, _, _ = self.__run(
+            ["rsync", "--recursive", "--delete", "--include-from=-", "--exclude=*",
+             empty + "/", rsync_location(target) + "/"],
+            "fanout-delete", "\n".join("/" + name for name in names))
+        return returncode == 0
+
+    def __run(self, command:list, command_name:str, stdin:str="") -> tuple:
+        """ Run a command returning its exit code, output lines and error lines. """
+        returncode, stdout, stderr, usage = command_usage.run(command, stdin)
+        if self.usage_recorder is not None:
+            self.usage_recorder.record(command_name, usage)
+        lines = stdout.decode("utf-8", errors="replace").splitlines()
+        errors = stderr.decode("utf-8", errors="replace").splitlines()
+        if self.command_log is not None:
+            for line in lines:
+                self.command_log.add_line(command_name, line, print_prefix="[Duplicity Fan Out]")
+            for line in errors:
+                self.command_log.add_line(
+                    command_name, line, print_prefix="[Duplicity Fan Out]", stream="stderr")
+        return returncode, lines, errors
+
+
+def rsync_location(target:DuplicityTarget) -> str:
+    """ Location of a target as an rsync command line argument. """
+    if target.backup_method == DuplicityBackupMethod.LOCAL:
+        return target.remote_path
+    return target.ssh_params.user + "@" + target.ssh_params.host + ":" + target.remote_path
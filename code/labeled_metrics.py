@@ -0,0 +1,17 @@
+"""Helpers for optional labeled prometheus metrics
+
+Metrics are passed in by the caller and may be None, so modules using these
+do not depend on prometheus_client themselves.
+"""
+
+
+def count(metric, amount:float=1, **labels):
+    """ Increment a labeled counter if one was given. """
+    if metric is not None:
+        metric.labels(**labels).inc(amount)
+
+
+def observe(metric, value:float, **labels):
+    """ Observe a value on a labeled histogram if one was given. """
+    if metric is not None:
+        metric.labels(**labels).observe(value)
@@ -0,0 +1,305 @@
+"""Lease limiting how many jobs use a shared backup server at once"""
+
+from dataclasses import dataclass
+
+import os
+import re
+import shlex
+import threading
+import time
+
+import command_usage
+
+TICKET_PREFIX = "ticket-"
+HELD_PREFIX = "held-"
+LOCK_NAME = "lock"
+LOCK_RETRY_INTERVAL = 1
+STORE_ATTEMPTS = 5
+STORE_RETRY_DELAY = 2
+
+
+@dataclass
+class LeaseParams:
+    """Setup params for the target lease."""
+    max_concurrent:int = 0 # 0 disables the lease
+    path:str = ""
+    ttl:int = 300
+    poll_interval:int = 15
+
+
+class LocalLeaseStore:
+    """Lease tickets kept in a directory shared between jobs."""
+
+    def __init__(self, path:str):
+        self.path = path
+
+    def create(self, name:str):
+        """ Create a ticket. """
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, name), "a", encoding="utf-8"):
+            pass
+
+    def touch(self, name:str):
+        """ Refresh a ticket so it is not expired, failing if it was removed. """
+        os.utime(os.path.join(self.path, name))
+
+    def remove(self, name:str):
+        """ Remove a ticket. """
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def rename(self, name:str, new_name:str):
+        """ Rename a ticket. """
+        os.rename(os.path.join(self.path, name), os.path.join(self.path, new_name))
+
+    def lock(self, ttl:int) -> bool:
+        """ Try to take the store lock, breaking one left for longer than ttl. """
+        os.makedirs(self.path, exist_ok=True)
+        location = os.path.join(self.path, LOCK_NAME)
+        try:
+            os.mkdir(location)
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.stat(location).st_mtime > ttl:
+                print("[Target Lease]: Breaking stale lease lock")
+                os.rmdir(location)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def unlock(self):
+        """ Release the store lock. """
+        os.rmdir(os.path.join(self.path, LOCK_NAME))
+
+    def list(self) -> tuple:
+        """ Return the store's current time and every ticket with its modified time. """
+        out = {}
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    if entry.name.startswith((TICKET_PREFIX, HELD_PREFIX)):
+                        try:
+                            out[entry.name] = entry.stat().st_mtime
+                        except FileNotFoundError:
+                            pass
+        except FileNotFoundError:
+            pass
+        return time.time(), out
+
+
+class SSHLeaseStore:
+    """Lease tickets kept in a directory on the backup server."""
+
+    def __init__(self, host:str, path:str, usage_recorder=None):
+        self.host = host
+        self.path = path
+        self.usage_recorder = usage_recorder
+
+    def create(self, name:str):
+        """ Create a ticket. """
+        self.__run("mkdir -p " + shlex.quote(self.path)
+                   + " && touch " + shlex.quote(self.path + "/" + name))
+
+    def touch(self, name:str):
+        """ Refresh a ticket so it is not expired, failing if it was removed. """
+        location = shlex.quote(self.path + "/" + name)
+        self.__run("[ -e " + location + " ] && touch -c " + location)
+
+    def remove(self, name:str):
+        """ Remove a ticket. """
+        self.__run("rm -f " + shlex.quote(self.path + "/" + name))
+
+    def rename(self, name:str, new_name:str):
+        """ Rename a ticket. """
+        self.__run("mv " + shlex.quote(self.path + "/" + name)
+                   + " " + shlex.quote(self.path + "/" + new_name))
+
+    def lock(self, ttl:int) -> bool:
+        """ Try to take the store lock, breaking one left for longer than ttl. """
+        location = shlex.quote(self.path + "/" + LOCK_NAME)
+        lines = self.__run(
+            "mkdir -p " + shlex.quote(self.path) + " && if mkdir " + location
+            + " 2>/dev/null; then echo locked; elif [ $(( $(date +%s) - $(stat -c %Y "
+            + location + " 2>/dev/null || date +%s) )) -gt " + str(int(ttl)) + " ]; then rmdir "
+            + location + " 2>/dev/null; echo stale; fi; true")
+        if lines and lines[0] == "stale":
+            print("[Target Lease]: Breaking stale lease lock")
+        return bool(lines) and lines[0] == "locked"
+
+    def unlock(self):
+        """ Release the store lock. """
+        self.__run("rmdir " + shlex.quote(self.path + "/" + LOCK_NAME))
+
+    def list(self) -> tuple:
+        """ Return the server's current time and every ticket with its modified time. """
+        lines = self.__run(
+            "date +%s.%N; cd " + shlex.quote(self.path) + " 2>/dev/null && for f in "
+            + TICKET_PREFIX + "* " + HELD_PREFIX + "*; do [ -e \"$f\" ] "
+            + "&& stat -c '%Y %n' \"$f\"; done; true")
+        out = {}
+        for line in lines[1:]:
+            mtime, _, name = line.partition(" ")
+            out[name] = float(mtime)
+        return float(lines[0]), out
+
+    def __run(self, command:str) -> list:
+        """ Run a shell command on the server. """
+        returncode, stdout, stderr, usage = command_usage.run(["ssh", self.host, command])
+        if self.usage_recorder is not None:
+            self.usage_recorder.record("lease", usage)
+        if returncode != 0:
+            raise RuntimeError(
+                "Lease command failed on " + self.host + ": "
+                + stderr.decode("utf-8", errors="replace").strip())
+        return stdout.decode("utf-8", errors="replace").splitlines()
+
+
+class TargetLease:
+    """
+    Counting semaphore over a lease store. Every job queues a ticket named
+    after the store's time when it asked. Under the store lock a job is
+    admitted, renaming its ticket to a held one, only while fewer than
+    max_concurrent live held tickets exist and it is among the oldest
+    queued, so the limit does not depend on the jobs' clocks. A ticket not
+    refreshed within ttl seconds belongs to a dead job and is removed by
+    whoever sees it.
+    """
+
+    def __init__(self, params:LeaseParams, store, job_id:str):
+        self.params = params
+        self.store = store
+        self.job_id = re.sub(r"[^A-Za-z0-9_.-]", "_", job_id)
+        self.ticket = ""
+        self.__heartbeat_stop = None
+        self.__heartbeat_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.params.max_concurrent > 0
+
+    @property
+    def held(self) -> bool:
+        return self.ticket.startswith(HELD_PREFIX)
+
+    def acquire(self, on_wait=None) -> float:
+        """
+        Block until this job holds the lease, calling on_wait with the queue
+        position while waiting, and return how long it waited.
+        Store errors are retried with backoff, once retries run out the
+        ticket is removed and the error raised.
+        """
+        start = time.time()
+        now, _ = self.__retry(self.store.list)
+        self.ticket = TICKET_PREFIX + str(int(now * 1000000000)).zfill(20) + "-" + self.job_id
+        self.__start_heartbeat()
+        try:
+            self.__retry(self.store.create, self.ticket)
+            while True:
+                position = self.__retry(self.__try_admit)
+                if position == 0:
+                    return time.time() - start
+                if on_wait is not None:
+                    on_wait(position)
+                time.sleep(self.params.poll_interval)
+        except (OSError, RuntimeError):
+            self.release()
+            raise
+
+    def release(self):
+        """ Give up the lease or our place in the queue. """
+        if not self.ticket:
+            return
+        with self.__heartbeat_lock:
+            self.__heartbeat_stop.set()
+            tickets = [self.ticket]
+            if not self.held:
+                # A rename may have gone through without us hearing back
+                tickets.append(HELD_PREFIX + self.ticket[len(TICKET_PREFIX):])
+            self.ticket = ""
+        for ticket in tickets:
+            try:
+                self.__retry(self.store.remove, ticket)
+            except (OSError, RuntimeError) as e:
+                # Left behind the ticket is expired by other jobs after ttl
+                print("[Target Lease]: Unable to remove " + ticket + ": " + str(e))
+
+    @staticmethod
+    def __retry(operation, *args):
+        """ Run a store operation, retrying failures with a doubling delay. """
+        delay = STORE_RETRY_DELAY
+        for attempt in range(STORE_ATTEMPTS):
+            try:
+                return operation(*args)
+            except (OSError, RuntimeError) as e:
+                if attempt == STORE_ATTEMPTS - 1:
+                    raise
+                print("[Target Lease]: Lease store failed, retrying in " + str(delay) + "s: "
+                      + str(e))
+                time.sleep(delay)
+                delay *= 2
+
+    def __try_admit(self) -> int:
+        """
+        Expire stale tickets and take the lease if there is room, returning
+        0 when admitted or how many jobs must finish before this one can be.
+        A failure part way through leaves nothing half done, so the whole
+        attempt can be retried.
+        """
+        while not self.store.lock(self.params.ttl):
+            time.sleep(LOCK_RETRY_INTERVAL)
+        try:
+            now, tickets = self.store.list()
+            held_ticket = HELD_PREFIX + self.ticket[len(TICKET_PREFIX):]
+            if held_ticket in tickets:
+                # An earlier attempt renamed our ticket but failed before hearing back
+                with self.__heartbeat_lock:
+                    self.ticket = held_ticket
+                return 0
+            holders = 0
+            queued = []
+            for name in sorted(tickets):
+                if name != self.ticket and now - tickets[name] > self.params.ttl:
+                    print("[Target Lease]: Expiring stale lease " + name)
+                    self.store.remove(name)
+                elif name.startswith(HELD_PREFIX):
+                    holders += 1
+                else:
+                    queued.append(name)
+            if self.ticket not in queued:
+                # Our own ticket was expired while we were paused, keep our place
+                self.store.create(self.ticket)
+                queued = sorted(queued + [self.ticket])
+            position = queued.index(self.ticket) + holders - self.params.max_concurrent + 1
+            if position > 0:
+                return position
+            with self.__heartbeat_lock:
+                self.store.rename(self.ticket, held_ticket)
+                self.ticket = held_ticket
+            return 0
+        finally:
+            try:
+                self.store.unlock()
+            except (OSError, RuntimeError) as e:
+                # Other jobs break the lock once it is older than ttl
+                print("[Target Lease]: Unable to release lease lock: " + str(e))
+
+    def __start_heartbeat(self):
+        """ Refresh the ticket in the background while it is queued or held. """
+        stop = threading.Event()
+        self.__heartbeat_stop = stop
+
+        def heartbeat():
+            while not stop.wait(max(1, self.params.ttl / 3)):
+                with self.__heartbeat_lock:
+                    if stop.is_set():
+                        return
+                    try:
+                        self.store.touch(self.ticket)
+                    except (OSError, RuntimeError) as e:
+                        print("[Target Lease]: Heartbeat failed: " + str(e))
+
+        threading.Thread(target=heartbeat, daemon=True).start()
@@ -0,0 +1,166 @@
+"""Dependency aware concurrent phase executor"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from enum import Enum
+
+import time
+
+
+class ResourceClass(Enum):
+    """Resources a phase holds while it runs."""
+    LOCAL_DISK = 0
+    REMOTE_BACKEND = 1
+
+
+# Duplicity takes a lock on its archive directory for every command, so only
+# one command can talk to the backend at a time whether it mutates it or not.
+DEFAULT_RESOURCE_LIMITS = {
+    ResourceClass.LOCAL_DISK: 2,
+    ResourceClass.REMOTE_BACKEND: 1,
+}
+
+
+@dataclass
+class Phase:
+    """A unit of work in a backup cycle."""
+    name:str
+    action:object
+    depends_on:list = field(default_factory=list)
+    resources:list = field(default_factory=list)
+
+
+@dataclass
+class PhaseTiming:
+    """Timing of a phase that ran."""
+    start:float = 0
+    end:float = 0
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class CycleTiming:
+    """Timing of a whole phase run."""
+    phases:dict = field(default_factory=dict)
+    skipped:list = field(default_factory=list) # Phases completed before this run
+    wall_time:float = 0
+    critical_path:float = 0
+    critical_path_phases:list = field(default_factory=list)
+
+
+class PhaseExecutor:
+    """
+    Runs phases on a thread pool as soon as their dependencies have finished
+    and their resource classes have capacity.
+    """
+
+    def __init__(self, max_workers:int=4, resource_limits:dict=None):
+        self.max_workers = max_workers
+        self.resource_limits = resource_limits or DEFAULT_RESOURCE_LIMITS
+
+    def run(self, phases:list, completed:dict=None,
+            on_phase_start=None, on_phase_complete=None) -> CycleTiming:
+        """
+        Run all phases, raising the first phase error once running phases finish.
+        Phases in completed, a dict of phase name to the duration it took, are
+        treated as already done and their durations used for the critical path.
+        on_phase_start is called with the phase name and on_phase_complete with
+        the name and its timing.
+        """
+        completed = completed or {}
+        by_name = {phase.name: phase for phase in phases}
+        for phase in phases:
+            for dependency in phase.depends_on:
+                if dependency not in by_name:
+                    raise ValueError(
+                        "Phase " + phase.name + " depends on unknown phase " + dependency)
+
+        out = CycleTiming()
+        pending = [phase for phase in phases if phase.name not in completed]
+        done = set(phase.name for phase in phases if phase.name in completed)
+        for name in sorted(done):
+            out.phases[name] = PhaseTiming(end=completed[name])
+            out.skipped.append(name)
+        in_use = {resource: 0 for resource in self.resource_limits}
+        running = {}
+        error = None
+        cycle_start = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                if error is None:
+                    for phase in list(pending):
+                        if not all(dependency in done for dependency in phase.depends_on):
+                            continue
+                        if not self.__has_capacity(phase, in_use):
+                            continue
+                        for resource in phase.resources:
+                            in_use[resource] += 1
+                        pending.remove(phase)
+                        if on_phase_start is not None:
+                            on_phase_start(phase.name)
+                        running[pool.submit(self.__run_phase, phase)] = phase
+                    if not running and pending:
+                        raise ValueError(
+                            "Phases can not be scheduled: "
+                            + ", ".join(phase.name for phase in pending))
+                elif not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    phase = running.pop(future)
+                    for resource in phase.resources:
+                        in_use[resource] -= 1
+                    try:
+                        out.phases[phase.name] = future.result()
+                        done.add(phase.name)
+                        if on_phase_complete is not None:
+                            on_phase_complete(phase.name, out.phases[phase.name])
+                    except Exception as e:
+                        if error is None:
+                            error = e
+        out.wall_time = time.time() - cycle_start
+        if error is not None:
+            raise error
+        self.__calculate_critical_path(phases, out)
+        return out
+
+    def __has_capacity(self, phase:Phase, in_use:dict) -> bool:
+        """ Check every resource class the phase needs has a free slot. """
+        for resource in phase.resources:
+            if in_use[resource] >= self.resource_limits[resource]:
+                return False
+        return True
+
+    @staticmethod
+    def __run_phase(phase:Phase) -> PhaseTiming:
+        """ Run a phase and time it. """
+        out = PhaseTiming(start=time.time())
+        phase.action()
+        out.end = time.time()
+        return out
+
+    @staticmethod
+    def __calculate_critical_path(phases:list, timing:CycleTiming):
+        """ Longest chain of dependent phase durations through the graph. """
+        finish = {}
+        previous = {}
+        remaining = list(phases)
+        while remaining:
+            for phase in list(remaining):
+                if all(dependency in finish for dependency in phase.depends_on):
+                    longest = max(
+                        phase.depends_on, key=lambda dependency: finish[dependency], default=None)
+                    finish[phase.name] = timing.phases[phase.name].duration + (
+                        finish[longest] if longest else 0)
+                    previous[phase.name] = longest
+                    remaining.remove(phase)
+        if not finish:
+            return
+        name = max(finish, key=lambda phase_name: finish[phase_name])
+        timing.critical_path = finish[name]
+        while name:
+            timing.critical_path_phases.insert(0, name)
+            name = previous[name]
@@ -0,0 +1,335 @@
+"""Opt in profiling of the exporter's own phases and memory"""
+
+from dataclasses import dataclass
+from enum import Enum
+
+import cProfile
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+PROFILE_EXTENSIONS = {".pstats", ".folded"}
+MAX_STACK_DEPTH = 64
+
+
+class ProfileMode(Enum):
+    """An enum to control how a phase is profiled."""
+    CPROFILE = 0
+    SAMPLING = 1
+
+
+@dataclass
+class ProfilingParams:
+    """Setup params for profiling."""
+    phases:str = "" # Comma separated phases profiled every cycle, * for all
+    mode:ProfileMode = ProfileMode.CPROFILE
+    http:bool = False
+    output_path:str = "/home/duplicity/config/profiles"
+    max_files:int = 20
+    sample_interval:float = 0.01
+    tracemalloc_interval:int = 0 # 0 disables allocation tracking
+    tracemalloc_frames:int = 1 # Above 1 sites are grouped by their call stack
+    tracemalloc_top:int = 20
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.phases.strip()) or self.http
+
+
+class PhaseProfiler:
+    """
+    Profiles backup cycle phases with cProfile, saved as pstats files, or a
+    sampling profiler, saved as collapsed stacks for flame graph tools.
+    Phases are profiled every cycle when listed in the params or once when
+    requested over HTTP. A requested phase in on_demand, which maps phase
+    names to actions safe to run outside a cycle, is run and profiled right
+    away unless a run of it is still going, any other waits for the cycle
+    whose start time next_run returns. Only names in phase_names can be
+    requested.
+    When profiling is disabled phase actions are left unwrapped so there is
+    no cost.
+    """
+
+    def __init__(self, params:ProfilingParams, phase_names:list=None, on_demand:dict=None,
+                 next_run=None):
+        self.params = params
+        self.on_demand = on_demand or {}
+        self.phase_names = set(phase_names or []) | set(self.on_demand)
+        self.next_run = next_run
+        self.always = set(name.strip() for name in params.phases.split(",") if name.strip())
+        self.__requested = {}
+        self.__running = set()
+        self.__lock = threading.Lock()
+        self.__cprofile_lock = threading.Lock()
+
+    def wrap_phases(self, phase_list:list) -> list:
+        """ Wrap the action of every phase that may be profiled. """
+        if self.params.enabled:
+            for phase in phase_list:
+                phase.action = self.wrap(phase.name, phase.action)
+        return phase_list
+
+    def wrap(self, name:str, action):
+        """ Wrap an action so it is profiled when its phase is asked for. """
+        if not self.params.enabled:
+            return action
+
+        def run_profiled():
+            mode = self.__take_mode(name)
+            if mode == ProfileMode.SAMPLING:
+                return self.__run_sampled(name, action)
+            if mode == ProfileMode.CPROFILE:
+                return self.__run_cprofiled(name, action)
+            return action()
+        return run_profiled
+
+    def request(self, names:list, mode:ProfileMode) -> tuple:
+        """
+        Profile the named phases, running on demand phases now and the rest
+        the next time they run. Returns the phases started now and the on
+        demand phases left alone as they are already running.
+        """
+        unknown = [name for name in names if name not in self.phase_names]
+        if unknown:
+            raise ValueError("Unknown phase " + ", ".join(unknown))
+        started = []
+        running = []
+        with self.__lock:
+            for name in names:
+                if name in self.__running:
+                    running.append(name)
+                elif name in self.on_demand:
+                    self.__running.add(name)
+                    started.append(name)
+                else:
+                    self.__requested[name] = mode
+        for name in started:
+            threading.Thread(
+                target=self.__run_on_demand, args=(name, mode), daemon=True).start()
+        return started, running
+
+    def list_files(self) -> list:
+        """ Saved profile file names, oldest first. """
+        try:
+            names = [name for name in os.listdir(self.params.output_path)
+                     if os.path.splitext(name)[1] in PROFILE_EXTENSIONS]
+        except FileNotFoundError:
+            return []
+        return sorted(names)
+
+    def serve(self, query:dict) -> tuple:
+        """
+        HTTP handler, ?phase=backup,local-size&mode=sampling requests a capture,
+        the response lists captures started, pending requests and saved profiles.
+        """
+        started = []
+        running = []
+        phase_names = [name.strip() for name in query.get("phase", [""])[0].split(",")
+                       if name.strip()]
+        if phase_names:
+            mode_name = query.get("mode", [self.params.mode.name])[0].upper()
+            if mode_name not in ProfileMode.__members__:
+                return ("400 Bad Request", "text/plain; charset=utf-8",
+                        "Unknown mode " + mode_name + "\n")
+            try:
+                started, running = self.request(phase_names, ProfileMode[mode_name])
+            except ValueError as e:
+                return ("400 Bad Request", "text/plain; charset=utf-8", str(e)
+                        + ", phases are " + ", ".join(sorted(self.phase_names)) + "\n")
+        with self.__lock:
+            requested = dict(self.__requested)
+        out = ["Profiled every cycle: " + (", ".join(sorted(self.always)) or "none")]
+        if started:
+            out.append("Running now: " + ", ".join(started))
+        if running:
+            out.append("Run already in progress, not started again: " + ", ".join(running))
+        out.append("Requested for the next cycle: " + (", ".join(
+            name + " (" + mode.name.lower() + ")" for name, mode in sorted(requested.items()))
+            or "none"))
+        if requested:
+            out.append("Next cycle: " + self.__describe_next_run())
+        out.append("Can be run now: " + (", ".join(sorted(self.on_demand)) or "none"))
+        out.append("Saved profiles (download from /debug/profile/file?name=...):")
+        out.extend("  " + name for name in self.list_files())
+        return "200 OK", "text/plain; charset=utf-8", "\n".join(out) + "\n"
+
+    def serve_file(self, query:dict) -> tuple:
+        """ HTTP handler returning a saved profile file. """
+        name = query.get("name", [""])[0]
+        if name not in self.list_files():
+            return "404 Not Found", "text/plain; charset=utf-8", "No profile named " + name + "\n"
+        with open(os.path.join(self.params.output_path, name), "rb") as fp:
+            return "200 OK", "application/octet-stream", fp.read()
+
+    def __describe_next_run(self) -> str:
+        """ When requested phases will next run. """
+        next_run = self.next_run() if self.next_run is not None else None
+        if next_run is None:
+            return "unknown"
+        if next_run <= time.time():
+            return "running now, phases that have not run yet are captured in it"
+        return (time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(next_run))
+                + " (in " + str(int(next_run - time.time())) + "s)")
+
+    def __run_on_demand(self, name:str, mode:ProfileMode):
+        """ Run and profile an on demand phase outside the cycle. """
+        try:
+            if mode == ProfileMode.SAMPLING:
+                self.__run_sampled(name, self.on_demand[name])
+            else:
+                self.__run_cprofiled(name, self.on_demand[name])
+        except Exception as e:
+            print("[Profiling]: On demand " + name + " failed: " + str(e))
+        finally:
+            with self.__lock:
+                self.__running.discard(name)
+
+    def __take_mode(self, name:str) -> ProfileMode:
+        """ Mode to profile a phase with this run, None when it is not profiled. """
+        with self.__lock:
+            mode = self.__requested.pop(name, None)
+        if mode is None and (name in self.always or "*" in self.always):
+            mode = self.params.mode
+        return mode
+
+    def __run_cprofiled(self, name:str, action):
+        """ Run an action under cProfile and save the stats. """
+        # Only one cProfile can be active at once on newer pythons
+        if not self.__cprofile_lock.acquire(blocking=False):
+            print("[Profiling]: Another phase is being profiled, sampling " + name + " instead")
+            return self.__run_sampled(name, action)
+        try:
+            profile = cProfile.Profile()
+            start = time.time()
+            try:
+                return profile.runcall(action)
+            finally:
+                profile.create_stats()
+                profile.dump_stats(self.__output_location(name, start, ".pstats"))
+        finally:
+            self.__cprofile_lock.release()
+
+    def __run_sampled(self, name:str, action):
+        """ Run an action while sampling its stack and save the collapsed stacks. """
+        thread_id = threading.get_ident()
+        counts = {}
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(self.params.sample_interval):
+                frame = sys._current_frames().get(thread_id)
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(os.path.basename(frame.f_code.co_filename)
+                                 + ":" + frame.f_code.co_name)
+                    frame = frame.f_back
+                if stack:
+                    key = ";".join(reversed(stack))
+                    counts[key] = counts.get(key, 0) + 1
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        start = time.time()
+        sampler.start()
+        try:
+            return action()
+        finally:
+            stop.set()
+            sampler.join()
+            with open(self.__output_location(name, start, ".folded"), "w", encoding="utf-8") as fp:
+                for stack, count in sorted(counts.items()):
+                    fp.write(stack + " " + str(count) + "\n")
+
+    def __output_location(self, name:str, start:float, extension:str) -> str:
+        """ File to save a profile to, removing the oldest profiles past max_files. """
+        os.makedirs(self.params.output_path, exist_ok=True)
+        existing = self.list_files()
+        for old_name in existing[:max(0, len(existing) - self.params.max_files + 1)]:
+            os.remove(os.path.join(self.params.output_path, old_name))
+        location = os.path.join(
+            self.params.output_path,
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(start)) + "-" + name + extension)
+        print("[Profiling]: Saving " + name + " profile to " + location)
+        return location
+
+
+class AllocationTracker:
+    """
+    Takes a tracemalloc snapshot every tracemalloc_interval seconds and
+    reports the largest allocation sites and how much each grew since the
+    previous snapshot and since tracking started. Tracing slows every
+    allocation, so it is only started when an interval is set.
+    """
+
+    def __init__(self, params:ProfilingParams):
+        self.params = params
+        self.report = "Allocation tracking is disabled, set TRACEMALLOC_INTERVAL to enable it\n"
+        self.__first = None
+        self.__previous = None
+        self.__lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.params.tracemalloc_interval > 0
+
+    def start(self):
+        """ Start tracing allocations and taking snapshots in the background. """
+        if not self.enabled:
+            return
+        tracemalloc.start(self.params.tracemalloc_frames)
+        with self.__lock:
+            self.report = "No snapshot taken yet\n"
+        threading.Thread(target=self.__snapshot_loop, daemon=True).start()
+
+    def serve(self, query:dict) -> tuple:
+        """ HTTP handler returning the latest allocation report. """
+        with self.__lock:
+            return "200 OK", "text/plain; charset=utf-8", self.report
+
+    def take_snapshot(self):
+        """ Snapshot allocations and rebuild the report. """
+        # Only per site totals are kept between snapshots so memory used by
+        # the tracker grows with allocation sites, not live allocations
+        group_by = "traceback" if self.params.tracemalloc_frames > 1 else "lineno"
+        sites = {" <- ".join(str(frame) for frame in stat.traceback): stat
+                 for stat in tracemalloc.take_snapshot().statistics(group_by)
+                 if stat.traceback[0].filename != tracemalloc.__file__}
+        current, peak = tracemalloc.get_traced_memory()
+        if self.__first is None:
+            self.__first = sites
+        top = self.params.tracemalloc_top
+        out = ["Traced memory: " + str(current) + " bytes, peak " + str(peak) + " bytes", ""]
+        out.append("Largest allocation sites:")
+        out.extend("  " + site + ": " + str(stat.size) + " bytes in " + str(stat.count) + " blocks"
+                   for site, stat in list(sites.items())[:top])
+        if self.__previous is not None:
+            out.append("")
+            out.append("Growth since previous snapshot:")
+            out.extend(self.__growth(sites, self.__previous, top))
+            out.append("")
+            out.append("Growth since tracking started:")
+            out.extend(self.__growth(sites, self.__first, top))
+        self.__previous = sites
+        with self.__lock:
+            self.report = "\n".join(out) + "\n"
+        print("[Profiling]: Traced memory " + str(current) + " bytes, peak " + str(peak) + " bytes")
+
+    @staticmethod
+    def __growth(sites:dict, old_sites:dict, top:int) -> list:
+        """ Report lines for the sites whose size changed most between two snapshots. """
+        changes = []
+        for site in set(sites) | set(old_sites):
+            size = sites[site].size if site in sites else 0
+            old_size = old_sites[site].size if site in old_sites else 0
+            if size != old_size:
+                changes.append((size - old_size, size, site))
+        changes.sort(key=lambda change: abs(change[0]), reverse=True)
+        return ["  " + site + ": " + ("+" if change > 0 else "") + str(change)
+                + " bytes, now " + str(size) + " bytes"
+                for change, size, site in changes[:top]]
+
+    def __snapshot_loop(self):
+        while True:
+            time.sleep(self.params.tracemalloc_interval)
+            self.take_snapshot()
@@ -7,8 +7,17 @@ import stat
 import copy
 import time
 import json
-from prometheus_client import start_http_server, Gauge, Enum
+import socket
+from prometheus_client import Counter, Gauge, Enum, Histogram
 import duplicity
+import command_log
+import command_usage
+import phases
+import fanout
+import checkpoint
+import lease
+import profiling
+from exporter_server import ExporterServer
 
 #24 hours
 ONE_DAY = "86400"
@@ -20,6 +29,12 @@ class AppMetricParams:
     backup_interval:int
     backup_name:str = "duplicity"
     duplicity_params:duplicity.DuplicityParams = field(default_factory=duplicity.DuplicityParams)
+    command_log_params:command_log.CommandLogParams = field(
+        default_factory=command_log.CommandLogParams)
+    phase_workers:int = 4
+    checkpoint_location:str = "/home/duplicity/config/cycle_state"
+    lease_params:lease.LeaseParams = field(default_factory=lease.LeaseParams)
+    profiling_params:profiling.ProfilingParams = field(default_factory=profiling.ProfilingParams)
 
 @dataclass
 class Metrics:
@@ -74,6 +89,108 @@ class Metrics:
         "Last Restore File Date",
         labelnames=['backup_name'])
 
+    retention_planned_chain_removals = Gauge(
+        "duplicity_retention_planned_chain_removals",
+        "Backup chains the last retention plan expects remove-all-but-n-full to delete",
+        labelnames=['backup_name'])
+    retention_planned_set_removals = Gauge(
+        "duplicity_retention_planned_set_removals",
+        "Backup sets the last retention plan expects each command to delete",
+        labelnames=['backup_name', 'command'])
+    retention_skipped_commands = Counter(
+        "duplicity_retention_skipped_commands",
+        "Clean commands skipped because the retention plan found nothing to delete",
+        labelnames=['backup_name', 'command'])
+
+    target_sync_success = Enum(
+        "duplicity_target_sync_success", "Last copy to an extra target succeeded",
+        states=["True", "False"], labelnames=['backup_name', 'target'])
+    target_sync_files = Gauge(
+        "duplicity_target_sync_files", "Files copied to an extra target by the last sync",
+        labelnames=['backup_name', 'target'])
+    target_sync_bytes = Gauge(
+        "duplicity_target_sync_bytes", "Bytes copied to an extra target by the last sync",
+        labelnames=['backup_name', 'target'])
+    target_sync_deleted_files = Gauge(
+        "duplicity_target_sync_deleted_files",
+        "Files removed from an extra target by the last sync",
+        labelnames=['backup_name', 'target'])
+    target_sync_duration = Gauge(
+        "duplicity_target_sync_duration_seconds", "Duration of the last sync to an extra target",
+        labelnames=['backup_name', 'target'])
+    target_num_full_backups = Gauge(
+        "duplicity_target_num_full_backups", "Number of Full Backups on each target",
+        labelnames=['backup_name', 'target'])
+    target_num_incremental_backups = Gauge(
+        "duplicity_target_num_incremental_backups", "Number of Incremental Backups on each target",
+        labelnames=['backup_name', 'target'])
+    target_size = Gauge(
+        "duplicity_target_size", "Size of the backup files on each target",
+        labelnames=['backup_name', 'target'])
+
+    phase_duration = Gauge(
+        "duplicity_phase_duration_seconds", "Duration of each backup cycle phase",
+        labelnames=['backup_name', 'phase'])
+    cycle_duration = Gauge(
+        "duplicity_cycle_duration_seconds", "Wall time of the last backup cycle",
+        labelnames=['backup_name'])
+    cycle_critical_path = Gauge(
+        "duplicity_cycle_critical_path_seconds",
+        "Longest chain of dependent phases in the last backup cycle",
+        labelnames=['backup_name'])
+
+    cycle_resumed = Enum(
+        "duplicity_cycle_resumed", "The current cycle resumed one interrupted by a restart",
+        states=["True", "False"], labelnames=['backup_name'])
+    resume_skipped_phases = Gauge(
+        "duplicity_resume_skipped_phases",
+        "Phases already completed before a restart that the resumed cycle skipped",
+        labelnames=['backup_name'])
+    resume_saved_seconds = Gauge(
+        "duplicity_resume_saved_seconds",
+        "Recorded duration of the phases the resumed cycle skipped",
+        labelnames=['backup_name'])
+
+    lease_wait = Gauge(
+        "duplicity_lease_wait_seconds", "Time the last cycle waited for the backup server lease",
+        labelnames=['backup_name'])
+    lease_queue_position = Gauge(
+        "duplicity_lease_queue_position",
+        "Jobs ahead of this one waiting for the backup server lease, 0 when not waiting",
+        labelnames=['backup_name'])
+    lease_held = Enum(
+        "duplicity_lease_held", "This job holds the backup server lease",
+        states=["True", "False"], labelnames=['backup_name'])
+
+    command_log_lines = Counter(
+        "duplicity_command_log_lines", "Lines of command output captured",
+        labelnames=['backup_name', 'command', 'stream'])
+    command_log_dropped_lines = Counter(
+        "duplicity_command_log_dropped_lines",
+        "Lines of command output evicted from the log buffer or not forwarded to stdout",
+        labelnames=['backup_name', 'command', 'reason'])
+
+    command_runs = Counter(
+        "duplicity_command_runs", "Commands run to completion",
+        labelnames=['backup_name', 'command'])
+    command_cpu_seconds = Counter(
+        "duplicity_command_cpu_seconds", "CPU time used by commands and their children",
+        labelnames=['backup_name', 'command', 'mode'])
+    command_io_bytes = Counter(
+        "duplicity_command_io_bytes", "Bytes commands and their children read and wrote to storage",
+        labelnames=['backup_name', 'command', 'direction'])
+    command_context_switches = Counter(
+        "duplicity_command_context_switches", "Context switches of commands and their children",
+        labelnames=['backup_name', 'command', 'kind'])
+    command_max_rss = Histogram(
+        "duplicity_command_max_rss_bytes", "Peak resident memory of each command run",
+        labelnames=['backup_name', 'command'],
+        buckets=[2 ** power for power in range(24, 34)] + [float("inf")])
+    command_duration = Histogram(
+        "duplicity_command_duration_seconds", "Wall time of each command run",
+        labelnames=['backup_name', 'command'],
+        buckets=[1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400, float("inf")])
+
 
 class AppMetrics:
     """
@@ -89,8 +206,43 @@ class AppMetrics:
         self.last_run_metrics = {}
         self.metrics = Metrics()
         self.metrics.backup_state.labels(backup_name=self.params.backup_name).state("Unkown")
-        self.duplicity = duplicity.Duplicity(params=params.duplicity_params)
+        self.command_log = command_log.CommandLog(
+            params=params.command_log_params,
+            backup_name=self.params.backup_name,
+            lines_metric=self.metrics.command_log_lines,
+            dropped_lines_metric=self.metrics.command_log_dropped_lines)
+        self.usage_recorder = command_usage.CommandUsageRecorder(
+            backup_name=self.params.backup_name,
+            runs_metric=self.metrics.command_runs,
+            cpu_metric=self.metrics.command_cpu_seconds,
+            io_metric=self.metrics.command_io_bytes,
+            context_switches_metric=self.metrics.command_context_switches,
+            max_rss_metric=self.metrics.command_max_rss,
+            duration_metric=self.metrics.command_duration)
+        self.duplicity = duplicity.Duplicity(
+            params=params.duplicity_params, command_log=self.command_log,
+            usage_recorder=self.usage_recorder)
+        self.replicator = fanout.TargetReplicator(
+            source=self.duplicity.primary_target,
+            targets=params.duplicity_params.extra_targets,
+            parallelism=params.duplicity_params.fanout_parallelism,
+            staging_path=params.duplicity_params.fanout_staging_path,
+            command_log=self.command_log,
+            usage_recorder=self.usage_recorder)
         self.last_run_metrics = copy.deepcopy(duplicity.metric_template)
+        self.last_collection_status = copy.deepcopy(duplicity.collection_status_metrics_template)
+        self.checkpoints = checkpoint.CheckpointStore(self.params.checkpoint_location)
+        self.lease = self.build_lease()
+        self.profiler = profiling.PhaseProfiler(
+            self.params.profiling_params,
+            phase_names=[phase.name for phase in self.build_cycle_phases()],
+            on_demand={
+                "local-size": self.update_local_folder_size,
+                "backup-size": self.update_backup_folder_size,
+            },
+            next_run=self.scheduled_next_run)
+        self.allocations = profiling.AllocationTracker(self.params.profiling_params)
+        self.checkpoint = None
 
     def pre_start_load(self):
         """Pre-Start metric load"""
@@ -160,24 +312,210 @@ class AppMetrics:
     def run_loop(self):
         """Backup fetching loop"""
         
+        executor = phases.PhaseExecutor(max_workers=self.params.phase_workers)
+        self.allocations.start()
+        self.checkpoint = self.checkpoints.load()
         while True:
-            self.run_collection_status()
+            self.start_or_resume_cycle()
             self.metrics.backup_state.labels(backup_name=self.params.backup_name).state("Running")
-            self.run_collection_status()
-            self.run_old_backup_clean()
-            self.run_cleanup()
-            self.run_collection_status()
-            self.process_pre_backup_date_write()
-            self.process_backup()
-            self.process_post_backup_date_read()
-            self.metrics.backup_state.labels(backup_name=self.params.backup_name).state("Cleaning Up")
-            self.run_old_backup_clean()
-            self.run_cleanup()
+            try:
+                self.save_cycle_timing(executor.run(
+                    self.profiler.wrap_phases(self.build_cycle_phases()),
+                    completed=self.checkpoint.completed,
+                    on_phase_start=self.save_phase_start,
+                    on_phase_complete=self.save_phase_complete))
+            finally:
+                self.release_lease()
+            self.checkpoint.finished = True
+            self.checkpoint.next_run = int(float(time.time()) + self.params.backup_interval)
+            self.checkpoints.save(self.checkpoint)
+            self.metrics.next_backup.labels(backup_name=self.params.backup_name).set(
+                self.checkpoint.next_run)
+            self.metrics.backup_state.labels(backup_name=self.params.backup_name).state("Waiting")
+            time.sleep(max(0, self.checkpoint.next_run - time.time()))
+
+    def start_or_resume_cycle(self):
+        """
+        Resume the saved cycle if a restart interrupted it, otherwise wait for
+        the saved next run time and start a new cycle.
+        """
+        saved = self.checkpoint
+        if saved is not None and not saved.finished:
+            skipped = [name for name in saved.completed if name in
+                       [phase.name for phase in self.build_cycle_phases()]]
+            print("Resuming interrupted cycle, skipping completed phases: " + ", ".join(skipped))
+            interrupted = [name for name in saved.started if name not in saved.completed]
+            if interrupted:
+                print("Phases interrupted part way and run again: " + ", ".join(interrupted))
+            self.metrics.cycle_resumed.labels(backup_name=self.params.backup_name).state("True")
+            self.metrics.resume_skipped_phases.labels(
+                backup_name=self.params.backup_name).set(len(skipped))
+            self.metrics.resume_saved_seconds.labels(backup_name=self.params.backup_name).set(
+                sum(saved.completed[name] for name in skipped))
+            if saved.collection_status is not None:
+                self.last_collection_status = saved.collection_status
+                self.save_last_collection_stats(self.last_collection_status)
+            return
+
+        if saved is not None and saved.next_run > time.time():
+            print("Waiting for scheduled next run")
             self.metrics.next_backup.labels(backup_name=self.params.backup_name).set(
-                int(float(time.time()) + self.params.backup_interval))
+                saved.next_run)
             self.metrics.backup_state.labels(backup_name=self.params.backup_name).state("Waiting")
-            self.run_collection_status()
-            time.sleep(self.params.backup_interval)
+            time.sleep(max(0, saved.next_run - time.time()))
+        self.metrics.cycle_resumed.labels(backup_name=self.params.backup_name).state("False")
+        self.metrics.resume_skipped_phases.labels(backup_name=self.params.backup_name).set(0)
+        self.metrics.resume_saved_seconds.labels(backup_name=self.params.backup_name).set(0)
+        self.checkpoint = checkpoint.CycleCheckpoint(cycle_start=time.time())
+        self.checkpoints.save(self.checkpoint)
+
+    def scheduled_next_run(self) -> float:
+        """Start time of the next backup cycle, now if one is running."""
+        if self.checkpoint is None:
+            return None
+        if not self.checkpoint.finished:
+            return time.time()
+        return self.checkpoint.next_run
+
+    def save_phase_start(self, name:str):
+        """Record a phase starting in the cycle checkpoint."""
+        if name not in self.checkpoint.started:
+            self.checkpoint.started.append(name)
+        self.checkpoints.save(self.checkpoint)
+
+    def save_phase_complete(self, name:str, timing:phases.PhaseTiming):
+        """Record a phase finishing in the cycle checkpoint."""
+        self.checkpoint.completed[name] = timing.duration
+        self.checkpoint.collection_status = self.last_collection_status
+        self.checkpoints.save(self.checkpoint)
+
+    def build_cycle_phases(self) -> list:
+        """Backup cycle as phases with their dependencies and resources."""
+        local = [phases.ResourceClass.LOCAL_DISK]
+        remote = [phases.ResourceClass.REMOTE_BACKEND]
+        return [
+            phases.Phase("collection-status", self.update_collection_status, resources=remote),
+            phases.Phase("local-size", self.update_local_folder_size, resources=local),
+            phases.Phase("backup-size", self.update_backup_folder_size, resources=local),
+            phases.Phase(
+                "pre-backup-retention", self.with_lease(self.run_planned_retention_and_refresh),
+                depends_on=["collection-status"], resources=remote),
+            phases.Phase("pre-backup-date-write", self.process_pre_backup_date_write, resources=local),
+            phases.Phase(
+                "backup", self.with_lease(self.process_backup),
+                depends_on=["pre-backup-retention", "pre-backup-date-write"],
+                resources=local + remote),
+            phases.Phase(
+                "post-backup-date-read", self.process_post_backup_date_read,
+                depends_on=["backup"], resources=remote),
+            phases.Phase(
+                "post-backup-collection-status", self.run_post_backup_collection_status,
+                depends_on=["backup"], resources=remote),
+            phases.Phase(
+                "post-backup-retention", self.with_lease(self.run_planned_retention_and_refresh),
+                depends_on=["post-backup-collection-status"], resources=remote),
+            phases.Phase(
+                "post-backup-size", self.update_backup_folder_size,
+                depends_on=["post-backup-retention"], resources=local),
+        ] + ([
+            phases.Phase(
+                "fanout", self.with_lease(self.run_fanout),
+                depends_on=["post-backup-retention"], resources=remote),
+        ] if self.replicator.targets else [])
+
+    def build_lease(self) -> lease.TargetLease:
+        """Lease shared with every job using the same backup server."""
+        duplicity_params = self.params.duplicity_params
+        lease_path = self.params.lease_params.path
+        if duplicity_params.backup_method == duplicity.DuplicityBackupMethod.SSH:
+            store = lease.SSHLeaseStore(
+                duplicity_params.ssh_params.host, lease_path or ".duplicity-leases",
+                usage_recorder=self.usage_recorder)
+        else:
+            store = lease.LocalLeaseStore(lease_path or os.path.join(
+                os.path.dirname(duplicity_params.location_params.remote_path.rstrip("/")),
+                ".duplicity-leases"))
+        return lease.TargetLease(
+            self.params.lease_params, store,
+            self.params.backup_name + "-" + socket.gethostname() + "-" + str(os.getpid()))
+
+    def with_lease(self, action):
+        """Wrap a phase action so it only runs while holding the backup server lease."""
+        def run_with_lease():
+            if self.acquire_lease():
+                action()
+        return run_with_lease
+
+    def acquire_lease(self) -> bool:
+        """
+        Wait for the backup server lease unless it is disabled or already held,
+        returning False when the lease store could not be reached.
+        """
+        if not self.lease.enabled or self.lease.held:
+            return True
+        print("[Target Lease]: Waiting for backup server lease")
+        try:
+            wait = self.lease.acquire(on_wait=self.metrics.lease_queue_position.labels(
+                backup_name=self.params.backup_name).set)
+        except (OSError, RuntimeError) as e:
+            print("[Target Lease]: Unable to acquire backup server lease, skipping phase: " + str(e))
+            self.metrics.lease_queue_position.labels(backup_name=self.params.backup_name).set(0)
+            return False
+        print("[Target Lease]: Acquired backup server lease after " + str(int(wait)) + "s")
+        self.metrics.lease_queue_position.labels(backup_name=self.params.backup_name).set(0)
+        self.metrics.lease_wait.labels(backup_name=self.params.backup_name).set(wait)
+        self.metrics.lease_held.labels(backup_name=self.params.backup_name).state("True")
+        return True
+
+    def release_lease(self):
+        """Release the backup server lease, or a place queued for it, at the end of a cycle."""
+        if self.lease.held:
+            print("[Target Lease]: Releasing backup server lease")
+        self.lease.release()
+        self.metrics.lease_held.labels(backup_name=self.params.backup_name).state("False")
+
+    def run_fanout(self):
+        """Copy the finished backup to the extra targets and export per target metrics."""
+        for result in self.replicator.run():
+            labels = {"backup_name": self.params.backup_name, "target": result.target}
+            self.metrics.target_sync_success.labels(**labels).state(str(result.success))
+            self.metrics.target_sync_files.labels(**labels).set(result.copied_files)
+            self.metrics.target_sync_bytes.labels(**labels).set(result.copied_bytes)
+            self.metrics.target_sync_deleted_files.labels(**labels).set(result.deleted_files)
+            self.metrics.target_sync_duration.labels(**labels).set(result.elapsed)
+            if result.listing.success:
+                self.save_target_listing(result.target, result.listing)
+        source_listing = self.replicator.list_target(self.duplicity.primary_target)
+        if source_listing.success:
+            self.save_target_listing(duplicity.target_url(self.duplicity.primary_target), source_listing)
+
+    def save_target_listing(self, target:str, listing:fanout.TargetListing):
+        """Publish backup counts and size of a target"""
+        labels = {"backup_name": self.params.backup_name, "target": target}
+        self.metrics.target_num_full_backups.labels(**labels).set(listing.full_backups)
+        self.metrics.target_num_incremental_backups.labels(**labels).set(
+            listing.incremental_backups)
+        self.metrics.target_size.labels(**labels).set(listing.size)
+
+    def save_cycle_timing(self, timing:phases.CycleTiming):
+        """Publish phase timings of a backup cycle"""
+        for name, phase_timing in timing.phases.items():
+            if name in timing.skipped:
+                # Keep the duration published when the phase really ran
+                continue
+            self.metrics.phase_duration.labels(
+                backup_name=self.params.backup_name, phase=name).set(phase_timing.duration)
+        self.metrics.cycle_duration.labels(
+            backup_name=self.params.backup_name).set(timing.wall_time)
+        self.metrics.cycle_critical_path.labels(
+            backup_name=self.params.backup_name).set(timing.critical_path)
+        print("Cycle finished in " + str(int(timing.wall_time)) + "s, critical path: "
+              + " -> ".join(timing.critical_path_phases))
+
+    def serve_command_log(self, query:dict) -> tuple:
+        """HTTP handler returning buffered command output."""
+        command_name = query.get("command", [""])[0]
+        return "200 OK", "text/plain; charset=utf-8", self.command_log.render(command_name)
 
     def run_restore(self):
         """Run duplicity restore."""
@@ -194,11 +532,64 @@ class AppMetrics:
         """Run duplicity cleanup command."""
         self.duplicity.run_cleanup()
 
+    def run_planned_retention(self) -> bool:
+        """
+        Plan old backup clean and cleanup from the last collection status,
+        run only the commands with something to delete and return if any ran.
+        """
+        plan = self.duplicity.plan_retention(self.last_collection_status)
+        self.save_retention_plan(plan)
+        ran = self.duplicity.run_old_backup_clean(plan)["ran"]
+        ran = self.duplicity.run_cleanup(plan)["ran"] or ran
+        return ran
+
+    def save_retention_plan(self, plan:dict):
+        """Publish retention plan"""
+        commands = {
+            "remove-all-but-n-full": (
+                plan["removeAllButNFull"], self.params.duplicity_params.remove_all_but_n_full > 0),
+            "remove-all-inc-of-but-n-full": (
+                plan["removeAllIncOfButNFull"],
+                self.params.duplicity_params.remove_all_inc_of_but_n_full > 0),
+            "cleanup": (plan["cleanup"], True),
+        }
+        self.metrics.retention_planned_chain_removals.labels(
+            backup_name=self.params.backup_name).set(plan["removeAllButNFull"]["chains"])
+        for command, (command_plan, enabled) in commands.items():
+            self.metrics.retention_planned_set_removals.labels(
+                backup_name=self.params.backup_name, command=command).set(command_plan["sets"])
+            if enabled and not command_plan["run"]:
+                self.metrics.retention_skipped_commands.labels(
+                    backup_name=self.params.backup_name, command=command).inc()
+
+    def run_planned_retention_and_refresh(self):
+        """Run planned retention and refresh collection status if it changed anything."""
+        if self.run_planned_retention():
+            self.update_collection_status()
+
+    def run_post_backup_collection_status(self):
+        """Refresh collection status once the backup has finished."""
+        self.metrics.backup_state.labels(backup_name=self.params.backup_name).state("Cleaning Up")
+        self.update_collection_status()
+
     def run_collection_status(self):
-        """Run duplicity collection status."""
-        self.save_last_collection_stats(self.duplicity.run_collection_status())
+        """Run duplicity collection status and folder size walks."""
+        self.update_collection_status()
+        self.update_local_folder_size()
+        self.update_backup_folder_size()
+
+    def update_collection_status(self):
+        """Run duplicity collection status and export it."""
+        self.last_collection_status = self.duplicity.run_collection_status()
+        self.save_last_collection_stats(self.last_collection_status)
+
+    def update_local_folder_size(self):
+        """Walk the folder to be backed up and export its size."""
         self.metrics.local_folder_size.labels(backup_name=self.params.backup_name).set(
             self.duplicity.get_local_size())
+
+    def update_backup_folder_size(self):
+        """Walk the backup folder and export its size."""
         self.metrics.backup_folder_size.labels(backup_name=self.params.backup_name).set(
             self.duplicity.get_backup_size())
 
@@ -264,16 +655,26 @@ def main():
     ssh_params.strict_host_key_checking = (
         str(os.getenv("DUPLICITY_SERVER_SSH_STRICT_HOST_KEY_CHECKING", "False")) == "True")
 
+    extra_targets = [
+        duplicity.parse_target_url(url, ssh_params)
+        for url in str(os.getenv("DUPLICITY_EXTRA_TARGETS", "")).split(",") if url.strip()]
+
+    ssh_hosts = []
     if duplicity_connection_type == duplicity.DuplicityBackupMethod.SSH:
+        ssh_hosts.append(ssh_params)
+    ssh_hosts += [target.ssh_params for target in extra_targets
+                  if target.backup_method == duplicity.DuplicityBackupMethod.SSH]
+    if ssh_hosts:
         if not os.path.exists("/home/duplicity/.ssh"):
             os.makedirs("/home/duplicity/.ssh", exist_ok=True)
         with open("/home/duplicity/.ssh/config", "w+", encoding="utf-8") as fp:
-                fp.write("Host " + ssh_params.host + "\r\n")
-                fp.write("  HostName " + ssh_params.host + "\r\n")
-                fp.write("  Port " + str(ssh_params.port) + "\r\n")
-                fp.write("  User " + ssh_params.user + "\r\n")
-                fp.write("  IdentityFile " + ssh_params.key_file + "\r\n")
-                if ssh_params.strict_host_key_checking:
+            for host_params in ssh_hosts:
+                fp.write("Host " + host_params.host + "\r\n")
+                fp.write("  HostName " + host_params.host + "\r\n")
+                fp.write("  Port " + str(host_params.port) + "\r\n")
+                fp.write("  User " + host_params.user + "\r\n")
+                fp.write("  IdentityFile " + host_params.key_file + "\r\n")
+                if host_params.strict_host_key_checking:
                     fp.write("  StrictHostKeyChecking yes\r\n")
                 else:
                     fp.write("  StrictHostKeyChecking no\r\n")
@@ -292,12 +693,21 @@ def main():
         remove_all_but_n_full=int(os.getenv("DUPLICITY_REMOVE_ALL_BUT_N_FULL", 0)),
         remove_all_inc_of_but_n_full=int(os.getenv("DUPLICITY_REMOVE_ALL_INC_OF_BUT_N_FULL", 0)),
         exclude_backup_dirs=str(os.getenv("EXCLUDE_BACKUP_DIRS", "")),
+        include_backup_dirs=str(os.getenv("INCLUDE_BACKUP_DIRS", "")),
         restore_to_time=str(os.getenv("RESTORE_TO_TIME", "")),
         verbosity=str(os.getenv("DUPLICITY_VERBOSITY", "")),
         location_params=duplicity_location_params,
         backup_method=duplicity_connection_type,
         allow_source_mismatch=(str(os.getenv("DUPLICITY_ALLOW_SOURCE_MISMATCH", "True")) == "True"),
-        ssh_params=ssh_params
+        execution_mode=(
+            duplicity.DuplicityExecutionMode.WORKER
+            if str(os.getenv("DUPLICITY_EXECUTION_MODE", "cli")).lower() == "worker"
+            else duplicity.DuplicityExecutionMode.CLI),
+        ssh_params=ssh_params,
+        extra_targets=extra_targets,
+        fanout_parallelism=int(os.getenv("DUPLICITY_FANOUT_PARALLELISM", "2")),
+        fanout_staging_path=str(
+            os.getenv("DUPLICITY_FANOUT_STAGING_PATH", "/home/duplicity/.cache/duplicity/fanout"))
     )
 
     app_metrics_params = AppMetricParams(
@@ -305,7 +715,32 @@ def main():
         duplicity_params = duplicity_params,
         last_metric_location = str(
             os.getenv("LAST_METRIC_LOCATION", "/home/duplicity/config/last_metrics")),
-        backup_interval = int(os.getenv("BACKUP_INTERVAL", ONE_DAY))
+        backup_interval = int(os.getenv("BACKUP_INTERVAL", ONE_DAY)),
+        checkpoint_location = str(
+            os.getenv("CYCLE_STATE_LOCATION", "/home/duplicity/config/cycle_state")),
+        lease_params = lease.LeaseParams(
+            max_concurrent=int(os.getenv("LEASE_MAX_CONCURRENT", "0")),
+            path=str(os.getenv("LEASE_PATH", "")),
+            ttl=int(os.getenv("LEASE_TTL", "300")),
+            poll_interval=int(os.getenv("LEASE_POLL_INTERVAL", "15"))),
+        phase_workers = int(os.getenv("PHASE_WORKERS", "4")),
+        profiling_params = profiling.ProfilingParams(
+            phases=str(os.getenv("PROFILE_PHASES", "")),
+            mode=(profiling.ProfileMode.SAMPLING
+                  if str(os.getenv("PROFILE_MODE", "cprofile")).lower() == "sampling"
+                  else profiling.ProfileMode.CPROFILE),
+            http=(str(os.getenv("PROFILE_HTTP", "False")) == "True"),
+            output_path=str(os.getenv("PROFILE_OUTPUT_PATH", "/home/duplicity/config/profiles")),
+            max_files=int(os.getenv("PROFILE_MAX_FILES", "20")),
+            sample_interval=int(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "10")) / 1000,
+            tracemalloc_interval=int(os.getenv("TRACEMALLOC_INTERVAL", "0")),
+            tracemalloc_frames=int(os.getenv("TRACEMALLOC_FRAMES", "1")),
+            tracemalloc_top=int(os.getenv("TRACEMALLOC_TOP", "20"))),
+        command_log_params = command_log.CommandLogParams(
+            buffer_bytes=int(os.getenv("COMMAND_LOG_BUFFER_KB", "64")) * 1024,
+            forward_stdout=(str(os.getenv("COMMAND_LOG_FORWARD_STDOUT", "True")) == "True"),
+            max_stdout_lines_per_second=int(
+                os.getenv("COMMAND_LOG_MAX_STDOUT_LINES_PER_SECOND", "50")))
     )
     app_metrics = AppMetrics(
         params=app_metrics_params
@@ -346,7 +781,14 @@ def main():
     print("Running pre-run load")
     app_metrics.pre_start_load()
 
-    start_http_server(exporter_port)
+    exporter_server = ExporterServer(exporter_port)
+    exporter_server.add_route("/logs", app_metrics.serve_command_log)
+    if app_metrics_params.profiling_params.http:
+        exporter_server.add_route("/debug/profile", app_metrics.profiler.serve)
+        exporter_server.add_route("/debug/profile/file", app_metrics.profiler.serve_file)
+    if app_metrics.allocations.enabled:
+        exporter_server.add_route("/debug/memory", app_metrics.allocations.serve)
+    exporter_server.start()
     print("Started")
     app_metrics.run_loop()
 
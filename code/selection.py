@@ -0,0 +1,148 @@
+"""Duplicity style include/exclude file selection"""
+
+from dataclasses import dataclass
+from enum import Enum
+
+import re
+
+IGNORE_CASE_PREFIX = "ignorecase:"
+
+
+class SelectionResult(Enum):
+    """Outcome of matching a path against the selection rules."""
+    EXCLUDE = 0
+    INCLUDE = 1
+    # Directory is not included itself but may contain included files
+    SCAN = 2
+
+
+@dataclass
+class SelectionRule:
+    """A single --include or --exclude glob."""
+    glob:str
+    include:bool = False
+
+
+def glob_to_regex(glob:str) -> str:
+    """ Translate a duplicity glob into a regex fragment. """
+    out = ""
+    i = 0
+    while i < len(glob):
+        char = glob[i]
+        if glob.startswith("**", i):
+            out += ".*"
+            i += 2
+            continue
+        if char == "*":
+            out += "[^/]*"
+        elif char == "?":
+            out += "[^/]"
+        elif char == "[":
+            end = glob.find("]", i + 1)
+            if end == -1:
+                out += re.escape(char)
+            else:
+                chars = glob[i + 1:end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                out += "[" + chars.replace("\\", "\\\\") + "]"
+                i = end
+        else:
+            out += re.escape(char)
+        i += 1
+    return out
+
+
+def glob_to_scan_regex(glob:str) -> str:
+    """
+    Build a regex matching every directory that may contain paths the glob
+    can match, like duplicity's glob_get_prefix_res: one alternative per
+    leading run of path segments, so a ** segment matches any depth.
+    """
+    parts = glob.split("/")
+    prefixes = ["/".join(parts[:index + 1]) or "/" for index in range(len(parts) - 1)]
+    if not prefixes:
+        return ""
+    return "(?:" + "|".join(glob_to_regex(prefix) for prefix in prefixes) + ")"
+
+
+class PathSelection:
+    """
+    Ordered include/exclude rules following duplicity's file selection
+    semantics: the first rule that matches a path decides, an excluded
+    directory excludes everything below it and paths no rule matches are
+    included. A glob ending in / only matches directories, so directory
+    paths are matched with a trailing / appended. Directories that may hold
+    included paths are SCAN, any other path matched only that way is not
+    backed up.
+    All rules are compiled into one regex so a lookup is a single match.
+    """
+
+    def __init__(self, rules:list):
+        self.rules = rules
+        self.has_directory_rules = False
+        self.__results = {}
+        alternatives = []
+        for index, rule in enumerate(self.rules):
+            glob = rule.glob
+            ignore_case = glob.lower().startswith(IGNORE_CASE_PREFIX)
+            if ignore_case:
+                glob = glob[len(IGNORE_CASE_PREFIX):]
+            directory_only = glob.endswith("/") and glob != "/"
+            self.has_directory_rules = self.has_directory_rules or directory_only
+            glob = glob.rstrip("/") or "/"
+            name = "r" + str(index)
+            # A directory only rule needs the trailing / of a directory path
+            # or a path below one
+            below = "/.*" if directory_only else "(?:/.*)?"
+            alternatives.append(
+                "(?P<" + name + ">" + self.__scoped(ignore_case, glob_to_regex(glob) + below) + ")")
+            self.__results[name] = (
+                SelectionResult.INCLUDE if rule.include else SelectionResult.EXCLUDE)
+            if rule.include:
+                scan_regex = glob_to_scan_regex(glob)
+                if scan_regex:
+                    alternatives.append(
+                        "(?P<" + name + "s>" + self.__scoped(ignore_case, scan_regex + "/?") + ")")
+                    self.__results[name + "s"] = SelectionResult.SCAN
+        self.__regex = re.compile("|".join(alternatives)) if alternatives else None
+
+    @classmethod
+    def from_globs(cls, include_globs:list=None, exclude_globs:list=None):
+        """ Build a selection with includes taking priority over excludes. """
+        rules = []
+        for glob in include_globs or []:
+            if glob.strip():
+                rules.append(SelectionRule(glob=glob.strip(), include=True))
+        for glob in exclude_globs or []:
+            if glob.strip():
+                rules.append(SelectionRule(glob=glob.strip(), include=False))
+        return cls(rules)
+
+    def match(self, path:str, is_dir:bool=False) -> SelectionResult:
+        """ Return how a path is selected. """
+        if self.__regex is None:
+            return SelectionResult.INCLUDE
+        if is_dir and not path.endswith("/"):
+            path += "/"
+        found = self.__regex.fullmatch(path)
+        if found is None:
+            return SelectionResult.INCLUDE
+        return self.__results[found.lastgroup]
+
+    def duplicity_args(self) -> list:
+        """ Return the rules as duplicity command line arguments. """
+        out = []
+        for rule in self.rules:
+            if rule.include:
+                out.append("--include=" + rule.glob)
+            else:
+                out.append("--exclude=" + rule.glob)
+        return out
+
+    @staticmethod
+    def __scoped(ignore_case:bool, regex:str) -> str:
+        """ Apply case folding to a single alternative only. """
+        if ignore_case:
+            return "(?i:" + regex + ")"
+        return regex
@@ -1,8 +1,11 @@
 # This module recursively gets the size of a folder
 # The maximum file path length it can read is 263 characters
+# An optional PathSelection prunes excluded subtrees without walking them
 import os
 import sys
 
+from selection import SelectionResult
+
 
 MAXIMUM_FILE_PATH_LENGTH = 263
 
@@ -55,7 +58,7 @@ def handle_single_or_except(path_name, except_value):
             raise RuntimeError(f'Unable to read {path_name}') from except_value
 
 
-def looper(path_name):
+def looper(path_name, selection=None):
 
     if os.path.islink(path_name):
         # this is a symbolic link, we should not traverse these due 
@@ -70,10 +73,10 @@ def looper(path_name):
         except Exception as exc:
             handle_single_or_except(path_name, exc)
 
-        return get_size(path_name)
+        return get_size(path_name, selection)
 
 
-def get_size(folder_name):
+def get_size(folder_name, selection=None):
     total = 0
 
     try:
@@ -84,6 +87,18 @@ def get_size(folder_name):
 
     for x in conts:
         y = os.path.join(folder_name, x)
-        total += looper(y)
+        if selection is not None:
+            # Only stat the entry when a rule cares whether it is a directory
+            is_dir = (selection.has_directory_rules
+                      and not os.path.islink(y) and os.path.isdir(y))
+            result = selection.match(y, is_dir)
+            if result == SelectionResult.EXCLUDE:
+                # excluded from the backup, skip the whole subtree
+                continue
+            if result == SelectionResult.SCAN and (os.path.islink(y) or not os.path.isdir(y)):
+                # duplicity only descends into scanned directories, other
+                # paths matched this way are not backed up
+                continue
+        total += looper(y, selection)
 
     return total
\ No newline at end of file